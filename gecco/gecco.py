@@ -23,6 +23,7 @@ import subprocess
 import json
 import traceback
 import random
+import struct
 import importlib
 import inspect
 from collections import OrderedDict, defaultdict
@@ -37,6 +38,23 @@ import yaml
 import folia.fql as fql #pylint: disable=import-error,no-name-in-module
 import folia.main as folia #pylint: disable=import-error,no-name-in-module
 from ucto import Tokenizer #pylint: disable=import-error,no-name-in-module
+try:
+    import msgpack #pylint: disable=import-error
+except ImportError:
+    msgpack = None #optional, for the compact binary protocol (FramedClient/FramedServerHandler)
+try:
+    import orjson #pylint: disable=import-error
+except ImportError:
+    orjson = None #optional, faster (de)serialisation for the JSON line protocol
+
+if orjson is not None:
+    def jsondumps(data):
+        """Serialises to JSON, directly to bytes"""
+        return orjson.dumps(data, option=orjson.OPT_NON_STR_KEYS)
+    jsonloads = orjson.loads
+else:
+    jsondumps = json.dumps
+    jsonloads = json.loads
 
 import gecco.helpers.evaluation
 from gecco.helpers.common import folia2json, makencname
@@ -952,13 +970,79 @@ class LineByLineServerHandler(socketserver.BaseRequestHandler):
             if msg == "%GETLOAD%":
                 response = str(self.server.module.server_load())
             else:
-                response = json.dumps(self.server.module.run(json.loads(msg)))
+                response = jsondumps(self.server.module.run(jsonloads(msg)))
             #print("Input: [" + msg + "], Response: [" + response + "]",file=sys.stderr)
             if isinstance(response,str):
                 response = response.encode('utf-8')
             if response[-1] != 10: response += b"\n"
             self.request.sendall(response)
 
+FRAMEHEADER = struct.Struct('<I') #length prefix of messages in the binary protocol
+
+def recvexactly(sock, size):
+    """Reads exactly size bytes from the socket, raises ConnectionError if the connection is closed prematurely"""
+    buffer = bytearray(size)
+    view = memoryview(buffer)
+    received = 0
+    while received < size:
+        n = sock.recv_into(view[received:], size - received)
+        if not n:
+            raise ConnectionError("Connection closed while receiving message")
+        received += n
+    return bytes(buffer)
+
+class FramedClient(LineByLineClient):
+    """Binary communication protocol between client and server, messages are msgpack payloads prefixed by their length (uint32)"""
+
+    def communicate(self, msg):
+        self.send(msg)
+        return self.receive()
+
+    def send(self, msg):
+        if not self.connected: self.connect()
+        self.socket.sendall(FRAMEHEADER.pack(len(msg)) + msg)
+
+    def receive(self):
+        if not self.connected: self.connect()
+        size = FRAMEHEADER.unpack(recvexactly(self.socket, FRAMEHEADER.size))[0]
+        return recvexactly(self.socket, size)
+
+    @staticmethod
+    def encode(data):
+        return msgpack.packb(data, use_bin_type=True)
+
+    @staticmethod
+    def decode(data):
+        return msgpack.unpackb(data, raw=False)
+
+class FramedServerHandler(socketserver.BaseRequestHandler):
+    """
+    The RequestHandler class for the binary protocol (see FramedClient). Instantiated once per connection to the server, invokes the module's run()
+    The textual %GETLOAD% request is still understood, so servers can be probed just like LineByLineServerHandler servers.
+    """
+
+    def handle(self):
+        while True: #We have to loop so the connection is not closed after one request
+            try:
+                header = recvexactly(self.request, FRAMEHEADER.size)
+            except ConnectionError: #connection broken
+                break
+            if header == b"%GET":
+                #legacy textual load request, read the remainder of the line
+                while header[-1] != 10:
+                    chunk = self.request.recv(1024)
+                    if not chunk:
+                        break
+                    header += chunk
+                self.request.sendall(str(self.server.module.server_load()).encode('utf-8') + b"\n")
+                continue
+            try:
+                msg = recvexactly(self.request, FRAMEHEADER.unpack(header)[0])
+            except ConnectionError: #connection broken
+                break
+            response = FramedClient.encode(self.server.module.run(FramedClient.decode(msg)))
+            self.request.sendall(FRAMEHEADER.pack(len(response)) + response)
+
 class ThreadedTCPServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
 
     def handle_error(self,request,client_address):
@@ -1137,7 +1221,22 @@ class Module:
 
     def runclient(self, client, unit_id, inputdata, **parameters):
         """This method gets invoked by the Corrector when it should connect to a remote server, the client instance is passed and already available (will connect on first communication). """
-        return json.loads(client.communicate(json.dumps(inputdata)))
+        if isinstance(client, FramedClient):
+            return client.decode(client.communicate(client.encode(inputdata)))
+        return jsonloads(client.communicate(jsondumps(inputdata)))
+
+    def setcodec(self):
+        """Selects the protocol between client and server according to the ``codec`` setting: ``msgpack`` (compact binary, the default if msgpack is installed) or ``json``. Modules that support it invoke this from verifysettings()"""
+        if 'codec' not in self.settings:
+            self.settings['codec'] = 'msgpack' if msgpack is not None else 'json'
+        if self.settings['codec'] == 'msgpack':
+            if msgpack is None:
+                raise Exception("Codec msgpack requested for module " + self.id + ", but the msgpack module is not installed")
+            #compact binary protocol between client and server instead of newline-delimited JSON
+            self.CLIENT = FramedClient
+            self.SERVER = FramedServerHandler
+        elif self.settings['codec'] != 'json':
+            raise Exception("Unknown codec for module " + self.id + ": " + str(self.settings['codec']))
 
     ##### Optional callbacks invoked by the Corrector (defaults may suffice)
 
@@ -19,7 +19,9 @@ def getcache(settings, cachesize=1000):
         settings['cachetype'] = 'fifo'
 
     if settings['cachetype'] == 'fifo':
-        return FIFOCache(cachesize)
+        return FIFOCache(settings['cachesize'])
+    elif settings['cachetype'] == 'lru':
+        return LRUCache(settings['cachesize'])
     else:
         raise Exception("invalid cache type: " + settings['cachetype'])
 
@@ -30,8 +32,31 @@ class FIFOCache(OrderedDict):
 
     def append(self, key, value):
         if self.size > 0:
-            if len(self) == self.size:
-                self.popitem(False)
+            #caches are shared by the threads of a module server, another thread may have appended or evicted in the meantime
+            while len(self) >= self.size:
+                try:
+                    self.popitem(False)
+                except KeyError:
+                    break
             self[key] = value
 
+class LRUCache(FIFOCache):
+    """Like FIFOCache, but every hit moves the entry to the end again, so frequently recurring keys are not evicted"""
+
+    def __getitem__(self, key):
+        value = super().__getitem__(key)
+        self.touch(key)
+        return value
+
+    def get(self, key, default=None):
+        value = super().get(key, default) #no exception on a miss
+        if value is not default:
+            self.touch(key)
+        return value
+
+    def touch(self, key):
+        try:
+            self.move_to_end(key)
+        except KeyError:
+            pass #evicted by another thread in the meantime
 
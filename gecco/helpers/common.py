@@ -1,9 +1,95 @@
+import os
+import io
+import sys
+import bz2
+import gzip
 import folia.main as folia
+#optional dependencies for (parallel) decompression of source corpora, the standard library is used as a fallback
+try:
+    import rapidgzip #pylint: disable=import-error
+except ImportError:
+    rapidgzip = None
+try:
+    import indexed_bzip2 #pylint: disable=import-error
+except ImportError:
+    indexed_bzip2 = None
+try:
+    import zstandard #pylint: disable=import-error
+except ImportError:
+    zstandard = None
 
 def stripsourceextensions(filename):
     #strip some common source extensions
-    return filename.replace('.txt','').replace('.bz2','').replace('.gz','').replace('.tok','')
+    return filename.replace('.txt','').replace('.bz2','').replace('.gz','').replace('.zst','').replace('.tok','')
 
+def checkcolibrisource(sourcefile):
+    """Raises an exception for source corpora that opensource() can read but colibri-core can not (zstd), call this before passing a source to colibri-core"""
+    if sourcefile.endswith(".zst"):
+        raise Exception("Source file " + sourcefile + " is zstd compressed, which colibri-core can not read. Decompress it (or recompress it with gzip or bzip2) first.")
+#sentence boundary markers used for padding contexts, interned so they are shared by all instances and features
+BEGINMARKER = sys.intern("<begin>")
+ENDMARKER = sys.intern("<end>")
+
+SOURCEBUFFERSIZE = 1024 * 1024 #read buffer for (large) source corpora
+
+def opensource(sourcefile):
+    """Opens a plain-text source corpus, possibly compressed (bz2, gz, zst), and returns a text stream for reading. Decompression is parallelised if rapidgzip or indexed_bzip2 are installed."""
+    if sourcefile.endswith(".bz2"):
+        if indexed_bzip2 is not None:
+            return io.TextIOWrapper(indexed_bzip2.open(sourcefile, parallelization=os.cpu_count()), encoding='utf-8', errors='ignore')
+        return io.TextIOWrapper(io.BufferedReader(bz2.open(sourcefile, mode='rb'), buffer_size=SOURCEBUFFERSIZE), encoding='utf-8', errors='ignore')
+    elif sourcefile.endswith(".gz"):
+        if rapidgzip is not None:
+            return io.TextIOWrapper(rapidgzip.open(sourcefile, parallelization=os.cpu_count()), encoding='utf-8', errors='ignore')
+        return io.TextIOWrapper(io.BufferedReader(gzip.open(sourcefile, mode='rb'), buffer_size=SOURCEBUFFERSIZE), encoding='utf-8', errors='ignore')
+    elif sourcefile.endswith(".zst"):
+        if zstandard is None:
+            raise Exception("Source file " + sourcefile + " is zstd compressed, but the zstandard module is not installed")
+        return zstandard.open(sourcefile, mode='rt', encoding='utf-8', errors='ignore')
+    return open(sourcefile, mode='rt', encoding='utf-8', errors='ignore', buffering=SOURCEBUFFERSIZE)
+
+def contextwindows(tokens, leftcontext, rightcontext, focusset, beginmarker=BEGINMARKER, endmarker=ENDMARKER, contextmap=None):
+    """Yields (leftcontext, focus, rightcontext) tuples for all tokens that are a member of focusset. Contexts are padded with the begin and end markers,
+    the result is equivalent to sliding a Windower of size leftcontext+1+rightcontext over the tokens, but no windows are built for tokens not in focus.
+    If contextmap is set (e.g. a hapaxer), it is called once on the full sequence of tokens and the context is taken from its output, the focus tokens are never mapped."""
+    if focusset.isdisjoint(tokens):
+        #nothing in focus, checked without entering the Python-level loop below
+        return
+    padded = None
+    for i, token in enumerate(tokens):
+        if token in focusset:
+            if padded is None:
+                #pad (and map) the tokens only once, and only if there is something in focus at all
+                context = tuple(tokens) if contextmap is None else tuple(contextmap(tokens))
+                padded = (beginmarker,) * leftcontext + context + (endmarker,) * rightcontext
+            j = i + leftcontext #position of the focus token in padded
+            yield padded[i:j], token, padded[j+1:j+1+rightcontext]
+
+class SentenceContext:
+    """Caches the word strings of the most recently seen sentence, so that the left and right context of words in that sentence can be
+    obtained by slicing instead of walking the FoLiA tree for every word. Contexts reaching beyond the sentence fall back to
+    word.leftcontext() and word.rightcontext(), which cross sentence boundaries."""
+
+    def __init__(self):
+        self.sentence = None
+        self.tokens = ()
+        self.index = {}
+
+    def __call__(self, word, leftsize, rightsize, beginmarker=BEGINMARKER, endmarker=ENDMARKER):
+        """Returns a (leftcontext, rightcontext) tuple of strings"""
+        try:
+            sentence = word.ancestor(folia.Sentence)
+        except folia.NoSuchAnnotation:
+            sentence = None
+        if sentence is not None and sentence is not self.sentence:
+            words = sentence.words()
+            self.sentence = sentence
+            self.tokens = tuple( sys.intern(str(w)) for w in words ) #interned, features are kept as cache keys
+            self.index = { w.id: i for i, w in enumerate(words) }
+        i = self.index.get(word.id) if sentence is not None and word.id is not None else None
+        if i is not None and i >= leftsize and i + rightsize < len(self.tokens):
+            return self.tokens[i-leftsize:i], self.tokens[i+1:i+1+rightsize]
+        return tuple( sys.intern(str(w)) for w in word.leftcontext(leftsize, beginmarker) ), tuple( sys.intern(str(w)) for w in word.rightcontext(rightsize, endmarker) )
 
 def makencname(name):
     ncname = ""
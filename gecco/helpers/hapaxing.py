@@ -13,27 +13,23 @@
 import colibricore #pylint: disable=import-error
 import os.path
 
-from gecco.helpers.common import stripsourceextensions
+from gecco.helpers.common import stripsourceextensions, checkcolibrisource, BEGINMARKER, ENDMARKER
+
+_HAPAX_DEFAULTS = {
+    'hapaxthreshold': 2,
+    'hapaxminlength': 0,
+    'hapaxmaxlength': 0,
+    'hapaxplaceholder': "<hapax>",
+    'hapaxsource': "",
+    'hapaxmodel': "",
+}
 
 def gethapaxer(module, settings):
     hapaxer = None
-    if 'hapaxsource' not in settings:
-        hapaxsource = ""
-    else:
-        hapaxsource = module.getfilename(settings['hapaxsource'])
-    if 'hapaxmodel' not in settings:
-        hapaxmodel = ""
-    else:
-        hapaxmodel = module.getfilename(settings['hapaxmodel'])
-    if 'hapaxthreshold' not in settings:
-        settings['hapaxthreshold'] = 2
-    if 'hapaxminlength' not in settings:
-        settings['hapaxminlength'] = 0
-    if 'hapaxmaxlength' not in settings:
-        settings['hapaxmaxlength'] = 0
-    if 'hapaxplaceholder' not in settings:
-        settings['hapaxplaceholder'] = "<hapax>"
-
+    for key, value in _HAPAX_DEFAULTS.items():
+        settings.setdefault(key, value)
+    hapaxsource = module.getfilename(settings['hapaxsource']) if settings['hapaxsource'] else ""
+    hapaxmodel = module.getfilename(settings['hapaxmodel']) if settings['hapaxmodel'] else ""
 
     if hapaxmodel:
         hapaxer = Hapaxer(hapaxsource, hapaxmodel, settings['hapaxthreshold'], settings['hapaxminlength'], settings['hapaxmaxlength'], settings['hapaxplaceholder'] )
@@ -53,7 +49,9 @@ class Hapaxer:
 
     """
 
-    def __init__(self, sourcefile, modelfile, threshold, minlength=0,maxlength=0, placeholder="<hapax>"):
+    __slots__ = ('sourcefile', 'modelfile', 'threshold', 'placeholder', 'minlength', 'maxlength', 'classencoder', 'lexicon', '_cache', '_cache_max', '_buildpattern', '_lex_get')
+
+    def __init__(self, sourcefile, modelfile, threshold, minlength=0,maxlength=0, placeholder="<hapax>", cachesize=100000):
         self.sourcefile = sourcefile
         self.modelfile = modelfile
         self.threshold = threshold
@@ -63,50 +61,86 @@ class Hapaxer:
 
         self.classencoder = None
         self.lexicon = None
+        #bound methods cached by _bind(), saves attribute lookups on every token
+        self._buildpattern = None
+        self._lex_get = None
+
+        self._cache = {} #word -> hapaxed word, spares a colibricore round trip for frequently recurring tokens
+        self._cache_max = cachesize
 
 
     def train(self):
         if self.sourcefile and not os.path.exists(self.modelfile):
-            classfile = stripsourceextensions(self.sourcefile) +  ".cls"
-            corpusfile = stripsourceextensions(self.sourcefile) +  ".dat"
-
-            if not os.path.exists(classfile):
+            checkcolibrisource(self.sourcefile)
+            sourceprefix = stripsourceextensions(self.sourcefile)
+            classfile = sourceprefix +  ".cls"
+            corpusfile = sourceprefix +  ".dat"
+            #check the filesystem only once for each file we may need to produce
+            have_cls = os.path.exists(classfile)
+            have_modelcls = os.path.exists(self.modelfile + '.cls')
+            have_corpus = os.path.exists(corpusfile)
+
+            if not have_cls:
                 self.classencoder = colibricore.ClassEncoder(self.minlength,self.maxlength)
                 self.classencoder.build(self.sourcefile)
                 self.classencoder.save(classfile)
             else:
                 self.classencoder = colibricore.ClassEncoder(classfile, self.minlength, self.maxlength)
 
-            if not os.path.exists(self.modelfile + '.cls'):
+            if not have_modelcls:
                 #make symlink to class file, using model name instead of source name
                 os.symlink(classfile, self.modelfile + '.cls')
 
-            if not os.path.exists(corpusfile):
+            if not have_corpus:
                 self.classencoder.encodefile( self.sourcefile, corpusfile)
 
             options = colibricore.PatternModelOptions(mintokens=self.threshold,minlength=1,maxlength=1)
             self.lexicon = colibricore.UnindexedPatternModel()
             self.lexicon.train(corpusfile, options)
             self.lexicon.write(self.modelfile)
+            self._bind()
 
 
     def load(self):
+        if self.lexicon is not None and self.classencoder is not None:
+            #already available, e.g. when train() was just invoked in this same process
+            return
         if not os.path.exists(self.modelfile):
             raise IOError("Missing expected model file for hapaxer:" + self.modelfile)
+        self._cache.clear()
         self.classencoder = colibricore.ClassEncoder(self.modelfile + '.cls')
         #self.classdecoder = colibricore.ClassDecoder(self.modelfile + '.cls')
         self.lexicon = colibricore.UnindexedPatternModel(self.modelfile)
+        self._bind()
+
+    def _bind(self):
+        self._buildpattern = self.classencoder.buildpattern
+        self._lex_get = self.lexicon.__getitem__
 
     def __getitem__(self, word):
-        if word in ('<begin>','<end>'): #EOS markers are never hapaxes
+        try:
+            return self._cache[word]
+        except KeyError:
+            pass
+        result = self._lookup(word)
+        if len(self._cache) < self._cache_max:
+            self._cache[word] = result
+        return result
+
+    def _lookup(self, word):
+        if word in (BEGINMARKER, ENDMARKER): #EOS markers are never hapaxes
             return word
+        l = len(word)
+        if (self.minlength and l < self.minlength) or (self.maxlength and l > self.maxlength):
+            #would not have been encoded by the class encoder anyway
+            return self.placeholder
         if self.lexicon is None: self.load()
-        pattern = self.classencoder.buildpattern(word)
+        pattern = self._buildpattern(word)
         if pattern.unknown():
             return self.placeholder
 
         try:
-            count = self.lexicon[pattern]
+            count = self._lex_get(pattern)
         except KeyError:
             return self.placeholder
         if count < self.threshold:
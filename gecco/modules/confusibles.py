@@ -13,20 +13,60 @@
 #pylint: disable=too-many-nested-blocks
 
 import os
-import io
-import bz2
-import gzip
-import sys
-import datetime
+import multiprocessing
+import functools
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
 import folia.main as folia
-from pynlpl.textprocessors import Windower
 from timbl import TimblClassifier #pylint: disable=import-error
 import colibricore #pylint: disable=import-error
 from gecco.gecco import Module
 from gecco.helpers.hapaxing import gethapaxer
-from gecco.helpers.common import stripsourceextensions
+from gecco.helpers.caching import getcache
+from gecco.helpers.common import stripsourceextensions, checkcolibrisource, contextwindows, opensource, SentenceContext
 from gecco.helpers.filters import nonumbers
 
+TRAINBUFFERSIZE = 1024 * 1024 #write buffer for Timbl training files
+TRAINBATCHSIZE = 100000 #number of source lines processed per batch when generating training instances
+
+_trainmodule = None #module generating training instances, inherited by forked worker processes
+
+def _traininstances(lines):
+    return _trainmodule.traininstances(lines)
+
+def generatetraininstances(module, f, processes=1):
+    """Yields blocks of Timbl training instances (utf-8 encoded bytes) for all lines in f, as returned by module.traininstances().
+    Batches of lines are distributed over the specified number of worker processes, the order of the output is preserved."""
+    global _trainmodule #pylint: disable=global-statement
+    batches = iter(lambda: list(islice(f, TRAINBATCHSIZE)), [])
+    linecount = 0
+    if processes <= 1:
+        for lines in batches:
+            yield module.traininstances(lines)
+            linecount += len(lines)
+            module.log(" processed " + str(linecount) + " lines") #once per batch, not per line
+    else:
+        _trainmodule = module
+        try:
+            #fork so workers inherit the module (and its loaded hapaxer) without pickling
+            with ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context('fork')) as executor:
+                pending = deque()
+                for lines in batches:
+                    pending.append( (len(lines), executor.submit(_traininstances, lines)) )
+                    while len(pending) >= 2 * processes or (pending and pending[0][1].done()): #bound the number of batches held in memory
+                        size, future = pending.popleft()
+                        yield future.result()
+                        linecount += size
+                        module.log(" processed " + str(linecount) + " lines")
+                while pending:
+                    size, future = pending.popleft()
+                    yield future.result()
+                    linecount += size
+                    module.log(" processed " + str(linecount) + " lines")
+        finally:
+            _trainmodule = None #also when training fails or is interrupted
+
 
 class TIMBLWordConfusibleModule(Module):
     """The Word Confusible module is capable of disambiguating two or more words that are often confused, by looking at their context.
@@ -40,11 +80,15 @@ class TIMBLWordConfusibleModule(Module):
     * ``class``        - Errors found by this module will be assigned the specified class in the resulting FoLiA output (default: confusible)
     * ``threshold``    - The probability threshold that classifier options must attain to be passed on as suggestions. (default: 0.8)
     * ``minocc``       - The minimum number of occurrences (sum of all class weights) (default: 5)
+    * ``trainprocesses`` - The number of processes used to generate training instances from the source corpus (default: 1)
+    * ``codec``        - Serialisation used between client and server: ``msgpack`` (compact binary, default if msgpack is installed) or ``json``
+    * ``batch``        - Process whole sentences rather than single words, so all confusibles in a sentence are classified in a single call (default: False)
 
     Sources and models:
     * a plain-text corpus (tokenized)  [``.txt``]     ->    a classifier instance base model [``.ibase``]
 
     Hapaxer: This module supports hapaxing
+    Caching: This module supports caching, classifications are cached per feature vector
     """
     UNIT = folia.Word
     UNITFILTER = nonumbers
@@ -70,23 +114,41 @@ class TIMBLWordConfusibleModule(Module):
         if 'minocc' not in self.settings:
             self.settings['minocc'] = 5
 
+        if 'trainprocesses' not in self.settings:
+            self.settings['trainprocesses'] = 1
+
+        self.setcodec()
+
+        if 'batch' in self.settings and self.settings['batch']:
+            self.UNIT = folia.Sentence #all confusibles in a sentence are classified in one go (and one server round-trip)
+
         self.hapaxer = gethapaxer(self, self.settings)
 
+        self.cache = getcache(self.settings, 100000) #2nd arg is default cache size
+        #context extraction for getfeatures(), caches the words of the last seen sentence and has the context sizes bound once
+        self.getcontext = functools.partial(SentenceContext(), leftsize=self.settings['leftcontext'], rightsize=self.settings['rightcontext'])
+
         if 'confusibles' not in self.settings:
             raise Exception("No confusibles specified for " + self.id + "!")
         self.confusibles = self.settings['confusibles']
+        self.confusibleset = frozenset(self.confusibles)
 
         if 'debug' in self.settings:
             self.debug = bool(self.settings['debug'])
         else:
             self.debug = False
 
+        #copied from the settings, these are consulted for every classified word
+        self.threshold = self.settings['threshold']
+        self.minocc = self.settings['minocc']
+
         try:
             modelfile = self.models[0]
             if not modelfile.endswith(".ibase"):
                 raise Exception("TIMBL models must have the extension ibase, got " + modelfile + " instead")
         except:
             raise Exception("Expected one model, got 0 or more")
+        self.fileprefix = modelfile[:-len(".ibase")] #extension is verified above, stripped from the end only
 
     def gettimbloptions(self):
         return "-F Tabbed " + "-a " + str(self.settings['algorithm']) + " +D +vdb -G0"
@@ -105,8 +167,7 @@ class TIMBLWordConfusibleModule(Module):
         if not os.path.exists(modelfile):
             raise IOError("Missing expected model file: " + modelfile + ". Did you forget to train the system?")
         self.log("Loading model file " + modelfile + "...")
-        fileprefix = modelfile.replace(".ibase","") #has been verified earlier
-        self.classifier = TimblClassifier(fileprefix, self.gettimbloptions(), normalize=False) #pylint: disable=attribute-defined-outside-init
+        self.classifier = TimblClassifier(self.fileprefix, self.gettimbloptions(), normalize=False) #pylint: disable=attribute-defined-outside-init
         self.classifier.load()
 
     def train(self, sourcefile, modelfile, **parameters):
@@ -114,75 +175,102 @@ class TIMBLWordConfusibleModule(Module):
             self.log("Training hapaxer...")
             self.hapaxer.train()
 
-        l = self.settings['leftcontext']
-        r = self.settings['rightcontext']
-        n = l + 1 + r
-
         self.log("Generating training instances...")
-        fileprefix = modelfile.replace(".ibase","") #has been verified earlier
-        classifier = TimblClassifier(fileprefix, self.gettimbloptions())
-        if sourcefile.endswith(".bz2"):
-            iomodule = bz2
-        elif sourcefile.endswith(".gz"):
-            iomodule = gzip
-        else:
-            iomodule = io
-        with iomodule.open(sourcefile,mode='rt',encoding='utf-8',errors='ignore') as f:
-            for i, line in enumerate(f):
-                if i % 100000 == 0: print(datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S") + " - " + str(i),file=sys.stderr)
-                for ngram in Windower(line, n):
-                    confusible = ngram[l]
-                    if confusible in self.settings['confusibles']:
-                        if self.hapaxer:
-                            ngram = self.hapaxer(ngram)
-                        leftcontext = tuple(ngram[:l])
-                        rightcontext = tuple(ngram[l+1:])
-                        classifier.append( leftcontext + rightcontext , confusible )
+        fileprefix = modelfile[:-len(".ibase")] #extension has been verified earlier
+        #instances are written directly in Timbl's tabbed format rather than passed through classifier.append()
+        with open(fileprefix + ".train",'wb',buffering=TRAINBUFFERSIZE) as out:
+            with opensource(sourcefile) as f:
+                for instances in generatetraininstances(self, f, self.settings['trainprocesses']):
+                    out.write(instances)
 
         self.log("Training classifier...")
+        classifier = TimblClassifier(fileprefix, self.gettimbloptions())
         classifier.train()
 
         self.log("Saving model " + modelfile)
         classifier.save()
 
+    def traininstances(self, lines):
+        """Returns the training instances for the given lines of the source corpus, in Timbl's tabbed format, as a single utf-8 encoded block"""
+        l = self.settings['leftcontext']
+        r = self.settings['rightcontext']
+        confusibles = self.confusibleset
+        instances = []
+        for line in lines:
+            if not any(confusible in line for confusible in confusibles):
+                continue #cheap substring test on the raw line, spares tokenisation of most lines
+            for leftcontext, confusible, rightcontext in contextwindows(line.split(), l, r, confusibles, contextmap=self.hapaxer):
+                instances.append("\t".join(leftcontext + rightcontext + (confusible,)) + "\n")
+        return "".join(instances).encode('utf-8') #encoded here, so this is done by the worker processes when training in parallel
+
 
     def getfeatures(self, word):
         """Get features at testing time, crosses sentence boundaries"""
-        leftcontext = tuple([ str(w) for w in word.leftcontext(self.settings['leftcontext'],"<begin>") ])
-        rightcontext = tuple([ str(w) for w in word.rightcontext(self.settings['rightcontext'],"<end>") ])
+        leftcontext, rightcontext = self.getcontext(word)
         return leftcontext + rightcontext
 
 
     def classify(self, features):
+        features = tuple(features) #may be a list when passed by the client
+        try:
+            return self.cache[features] #contexts recur a lot, the same features need not be classified again
+        except KeyError:
+            pass
+        result = self.classifyuncached(features)
+        self.cache.append(features, result)
+        return result
+
+    def classifyuncached(self, features):
         if self.hapaxer: features = self.hapaxer(features)
         best,distribution,_ = self.classifier.classify(features)
         sumweights = sum(distribution.values())
         if self.debug: self.log("(Classified " + repr(features) + ", best=" + best + ", sumweights=" + str(sumweights) + ", distribution=" + repr(distribution) + ")")
-        if sumweights < self.settings['minocc']:
+        if sumweights < self.minocc:
             if self.debug: self.log("(Not passing minocc threshold)")
             return best, []
-        distribution = { sug: weight/sumweights for sug,weight in distribution.items() if weight/sumweights >= self.settings['threshold'] }
+        threshold = self.threshold
+        distribution = { sug: p for sug, p in ( (sug, weight/sumweights) for sug,weight in distribution.items() ) if p >= threshold } #each weight is normalised only once
         if self.debug: self.log("(Returning " + str(len(distribution)) + " suggestions after filtering)")
         return best,distribution
 
-    def prepareinput(self,word,**parameters):
+    def prepareinput(self,unit,**parameters):
         """Takes the specified FoLiA unit for the module, and returns a string that can be passed to process()"""
+        if self.UNIT is folia.Sentence:
+            #batch mode: (word_id, wordstr, features) for all confusibles in the sentence
+            inputdata = []
+            for word in unit.words():
+                wordinput = self.prepareword(word)
+                if wordinput is not None:
+                    inputdata.append( (word.id,) + wordinput )
+            return inputdata if inputdata else None
+        return self.prepareword(unit)
+
+    def prepareword(self, word):
+        if not self.UNITFILTER(word): #the word itself is filtered here in both modes, ProcessorThread only gets to see the prepared input
+            return None
         wordstr = str(word) #will be reused in processoutput
-        if wordstr in self.confusibles:
+        if wordstr in self.confusibleset:
             features = self.getfeatures(word)
             return wordstr, features
 
     def run(self, inputdata):
         """This method gets called by the module's server and handles a message by the client. The return value (str) is returned to the client"""
+        if self.UNIT is folia.Sentence:
+            return [ self.classify(features) for _, _, features in inputdata ]
         _, features = inputdata
         best, distribution = self.classify(features)
         return (best,distribution)
 
     def processoutput(self, output, inputdata, unit_id,**parameters):
+        if self.UNIT is folia.Sentence:
+            return [ query for query in ( self.processword(wordoutput, wordstr, word_id) for (word_id, wordstr, _), wordoutput in zip(inputdata, output) ) if query is not None ]
         wordstr, _  = inputdata
+        return self.processword(output, wordstr, unit_id)
+
+    def processword(self, output, wordstr, word_id):
         best,distribution = output
         if best and best != wordstr and distribution:
-            return self.addsuggestions(unit_id, list(distribution.items()))
+            return self.addsuggestions(word_id, list(distribution.items()))
 
 
 class TIMBLSuffixConfusibleModule(Module):
@@ -200,12 +288,16 @@ class TIMBLSuffixConfusibleModule(Module):
     * ``class``        - Errors found by this module will be assigned the specified class in the resulting FoLiA output (default: confusible)
     * ``threshold``    - The probability threshold that classifier options must attain to be passed on as suggestions. (default: 0.8)
     * ``minocc``       - The minimum number of occurrences (sum of all class weights) (default: 5)
+    * ``trainprocesses`` - The number of processes used to generate training instances from the source corpus (default: 1)
+    * ``codec``        - Serialisation used between client and server: ``msgpack`` (compact binary, default if msgpack is installed) or ``json``
+    * ``batch``        - Process whole sentences rather than single words, so all confusibles in a sentence are classified in a single call (default: False)
 
     Sources and models:
     * a plain-text corpus (tokenized)  [``.txt``]     ->    a list of confusibles [``.lst``]
     * a plain-text corpus (tokenized)  [``.txt``]     ->    a classifier instance base model [``.ibase``]
 
     Hapaxer: This module supports hapaxing
+    Caching: This module supports caching, classifications are cached per feature vector
     """
     UNIT = folia.Word
     UNITFILTER = nonumbers
@@ -230,12 +322,27 @@ class TIMBLSuffixConfusibleModule(Module):
         if 'minocc' not in self.settings:
             self.settings['minocc'] = 5
 
+        if 'trainprocesses' not in self.settings:
+            self.settings['trainprocesses'] = 1
+
+        self.setcodec()
+
+        if 'batch' in self.settings and self.settings['batch']:
+            self.UNIT = folia.Sentence #all confusibles in a sentence are classified in one go (and one server round-trip)
+
         self.hapaxer = gethapaxer(self, self.settings)
 
+        self.cache = getcache(self.settings, 100000) #2nd arg is default cache size
+        #context extraction for getfeatures(), caches the words of the last seen sentence and has the context sizes bound once
+        self.getcontext = functools.partial(SentenceContext(), leftsize=self.settings['leftcontext'], rightsize=self.settings['rightcontext'])
+
 
         if 'suffixes' not in self.settings:
             raise Exception("No suffixes specified for " + self.id + "!")
         self.suffixes = sorted(self.settings['suffixes'], key= lambda x: -1* len(x))  #sort from long to short
+        #suffixes grouped by length (long to short), matching then takes only one slice and set lookup per distinct length
+        self.suffixbuckets = [ (length, frozenset(s for s in self.suffixes if len(s) == length)) for length in sorted(set(len(s) for s in self.suffixes), reverse=True) ]
+        self.suffixindex = {} #confusible -> (suffix, normalized), filled by getsuffix()
 
         #settings for computation of confusible list
         if 'freqthreshold' not in self.settings:
@@ -252,6 +359,10 @@ class TIMBLSuffixConfusibleModule(Module):
         else:
             self.debug = False
 
+        #copied from the settings, these are consulted for every classified word
+        self.threshold = self.settings['threshold']
+        self.minocc = self.settings['minocc']
+
 
         ibasefound = lstfound = False
         for filename in self.models:
@@ -266,6 +377,7 @@ class TIMBLSuffixConfusibleModule(Module):
             raise Exception("TIMBL models must have the extension ibase, not model file was supplies with that extension")
         if not lstfound:
             raise Exception("Specify a model file with extension lst that will store all confusibles found")
+        self.fileprefix = self.modelfile[:-len(".ibase")] #extension is verified above, stripped from the end only
 
     def gettimbloptions(self):
         return "-F Tabbed " + "-a " + str(self.settings['algorithm']) + " +D +vdb -G0"
@@ -280,38 +392,41 @@ class TIMBLSuffixConfusibleModule(Module):
             raise Exception("Specify one or more models to load!")
 
 
-        self.confusibles = []#pylint: disable=attribute-defined-outside-init
-
         self.log("Loading models...")
-        if not os.path.exists(self.confusiblefile):
-            raise IOError("Missing expected confusible file: "  + self.confusiblefile + ". Did you forget to train the system?")
-        with open(self.confusiblefile,'r',encoding='utf-8') as f:
-            for line in f:
-                line = line.strip()
-                if line:
-                    self.confusibles.append(line)
+        self.loadconfusibles()
         if not os.path.exists(self.modelfile):
             raise IOError("Missing expected model file: " + self.modelfile + ". Did you forget to train the system?")
         self.log("Loading Timbl model file " + self.modelfile + "...")
-        fileprefix = self.modelfile.replace(".ibase","") #has been verified earlier
-        self.classifier = TimblClassifier(fileprefix, self.gettimbloptions(), normalize=False) #pylint: disable=attribute-defined-outside-init
+        self.classifier = TimblClassifier(self.fileprefix, self.gettimbloptions(), normalize=False) #pylint: disable=attribute-defined-outside-init
         self.classifier.load()
 
     def clientload(self):
         self.log("Loading models (for client)...")
-        self.confusibles = []#pylint: disable=attribute-defined-outside-init
+        self.loadconfusibles()
+
+    def loadconfusibles(self):
+        """Loads the confusibles found at training time, as a list (in order) and as a set (for membership tests)"""
         if not os.path.exists(self.confusiblefile):
             raise IOError("Missing expected confusible file: "  + self.confusiblefile + ". Did you forget to train the system?")
         with open(self.confusiblefile,'r',encoding='utf-8') as f:
-            for line in f:
-                line = line.strip()
-                if line:
-                    self.confusibles.append(line)
+            self.setconfusibles([ line for line in ( x.strip() for x in f.read().split("\n") ) if line ])
+
+    def setconfusibles(self, confusibles):
+        """Sets the confusibles (a list) and precomputes the membership set and the suffix of each of them"""
+        self.confusibles = confusibles #pylint: disable=attribute-defined-outside-init
+        self.confusibleset = frozenset(confusibles) #pylint: disable=attribute-defined-outside-init
+        #resolve all suffixes in advance, training and run time lookups are then (shared) dictionary hits, also in forked workers
+        suffixes = tuple(self.suffixes)
+        for confusible in confusibles:
+            if not confusible.endswith(suffixes):
+                self.log("WARNING: Confusible " + confusible + " does not end in any of the configured suffixes!")
+            self.getsuffix(confusible)
 
     def train(self, sourcefile, modelfile, **parameters):
         if modelfile == self.confusiblefile:
             #Build frequency list
             self.log("Preparing to generate lexicon for suffix confusible module")
+            checkcolibrisource(sourcefile)
             classfile = stripsourceextensions(sourcefile) +  ".cls"
             corpusfile = stripsourceextensions(sourcefile) +  ".dat"
 
@@ -335,144 +450,187 @@ class TIMBLSuffixConfusibleModule(Module):
             model.train(corpusfile, options)
 
 
-            self.log("Finding confusible pairs")
+            self.log("Decoding frequency list")
             classdecoder = colibricore.ClassDecoder(classfile)
-            self.confusibles = [] #pylint: disable=attribute-defined-outside-init
-            for pattern in model:
+            #decode all patterns in a single pass, the search below then works on plain strings and frequencies
+            unigrams = {} #string -> frequency, a single lookup tells whether a candidate exists and how frequent it is
+            for pattern, freq in model.items():
                 try:
-                    pattern_s = pattern.tostring(classdecoder)
+                    unigrams[pattern.tostring(classdecoder)] = freq
                 except UnicodeDecodeError:
                     self.log("WARNING: Unable to decode a pattern in the model!!! Invalid utf-8!")
-                for suffix in self.suffixes:
-                    if pattern_s.endswith(suffix) and not pattern_s in self.confusibles:
+
+            self.log("Finding confusible pairs")
+            maxratio = self.settings['maxratio']
+            self.confusibles = [] #pylint: disable=attribute-defined-outside-init
+            confusibleset = set()
+            suffixtuple = tuple(self.suffixes)
+            for pattern_s, freq in unigrams.items():
+                if not pattern_s.endswith(suffixtuple):
+                    continue #ends in none of the suffixes, checked in a single call
+                for length, suffixes in self.suffixbuckets:
+                    suffix = pattern_s[-length:]
+                    if suffix in suffixes and not pattern_s in confusibleset:
                         found = []
                         for othersuffix in self.suffixes:
                             if othersuffix != suffix:
-                                otherpattern_s = pattern_s[:-len(suffix)] + othersuffix
-                                try:
-                                    otherpattern = classencoder.buildpattern(otherpattern_s,False,False)
-                                except KeyError:
+                                otherpattern_s = pattern_s[:-length] + othersuffix
+                                otherfreq = unigrams.get(otherpattern_s)
+                                if otherfreq is None: #unknown or not in the model
                                     if found: found = []
                                     break
-                                if not otherpattern in model:
-                                    if found: found = []
-                                    break
-                                if self.settings['maxratio'] != 0:
-                                    freqs = (model.occurrencecount(pattern), model.occurrencecount(otherpattern))
-                                    ratio = max(freqs) / min(freqs)
-                                    if ratio < self.settings['maxratio']:
+                                if maxratio != 0:
+                                    ratio = max(freq, otherfreq) / min(freq, otherfreq)
+                                    if ratio < maxratio:
                                         if found: found = []
                                         break
                                 found.append(otherpattern_s )
                         if found:
                             self.confusibles.append(pattern_s)
+                            confusibleset.add(pattern_s)
                             for s in found:
                                 self.confusibles.append(s)
+                                confusibleset.add(s)
+
+            self.setconfusibles(self.confusibles)
 
             self.log("Writing confusible list")
             with open(modelfile,'w',encoding='utf-8') as f:
-                for confusible in self.confusibles:
-                    f.write(confusible + "\n")
+                f.write("".join( confusible + "\n" for confusible in self.confusibles )) #single write
 
         elif modelfile == self.modelfile:
             try:
-                self.confusibles
+                self.confusibleset
             except AttributeError:
-                self.confusibles = []
                 self.log("Loading confusiblefile")
-                with open(self.confusiblefile,'r',encoding='utf-8') as f:
-                    for line in f:
-                        line = line.strip()
-                        if line:
-                            self.confusibles.append(line)
+                self.loadconfusibles()
 
             if self.hapaxer:
                 self.log("Training hapaxer...")
                 self.hapaxer.train()
 
-            l = self.settings['leftcontext']
-            r = self.settings['rightcontext']
-            n = l + 1 + r
-
             self.log("Generating training instances...")
-            fileprefix = modelfile.replace(".ibase","") #has been verified earlier
-            classifier = TimblClassifier(fileprefix, self.gettimbloptions())
-            if sourcefile.endswith(".bz2"):
-                iomodule = bz2
-            elif sourcefile.endswith(".gz"):
-                iomodule = gzip
-            else:
-                iomodule = io
-            with iomodule.open(sourcefile,mode='rt',encoding='utf-8', errors='ignore') as f:
-                for i, line in enumerate(f):
-                    for ngram in Windower(line, n):
-                        if i % 100000 == 0: print(datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S") + " - " + str(i),file=sys.stderr)
-                        confusible = ngram[l]
-                        if confusible in self.confusibles:
-                            if self.hapaxer:
-                                ngram = self.hapaxer(ngram)
-                            leftcontext = tuple(ngram[:l])
-                            rightcontext = tuple(ngram[l+1:])
-                            suffix, normalized = self.getsuffix(confusible)
-                            if suffix is not None:
-                                classifier.append( leftcontext + (normalized,) + rightcontext , suffix )
+            fileprefix = self.fileprefix
+            #instances are written directly in Timbl's tabbed format rather than passed through classifier.append()
+            with open(fileprefix + ".train",'wb',buffering=TRAINBUFFERSIZE) as out:
+                with opensource(sourcefile) as f:
+                    for instances in generatetraininstances(self, f, self.settings['trainprocesses']):
+                        out.write(instances)
 
             self.log("Training classifier...")
+            classifier = TimblClassifier(fileprefix, self.gettimbloptions())
             classifier.train()
 
             self.log("Saving model " + modelfile)
             classifier.save()
 
+    def traininstances(self, lines):
+        """Returns the training instances for the given lines of the source corpus, in Timbl's tabbed format, as a single utf-8 encoded block"""
+        l = self.settings['leftcontext']
+        r = self.settings['rightcontext']
+        confusibles = self.confusibleset
+        instances = []
+        for line in lines:
+            for leftcontext, confusible, rightcontext in contextwindows(line.split(), l, r, confusibles, contextmap=self.hapaxer):
+                suffix, normalized = self.getsuffix(confusible)
+                if suffix is not None:
+                    instances.append("\t".join(leftcontext + (normalized,) + rightcontext + (suffix,)) + "\n")
+        return "".join(instances).encode('utf-8') #encoded here, so this is done by the worker processes when training in parallel
+
 
     def getsuffix(self, confusible):
+        try:
+            return self.suffixindex[confusible] #memoised, only known confusibles are ever passed in practice
+        except KeyError:
+            pass
         assert isinstance(confusible, str)
-        suffix = None
-        for suffix in self.suffixes: #suffixes are sorted from long to short
-            if confusible.endswith(suffix):
-                break
-        if suffix is None:
+        for length, suffixes in self.suffixbuckets: #buckets are sorted from long to short
+            suffix = confusible[-length:]
+            if suffix in suffixes:
+                result = (suffix, confusible[:-length] + self.suffixes[0])  #suffix, normalized
+                self.suffixindex[confusible] = result
+                return result
+        if not self.suffixes:
             raise ValueError("No suffix found!")
-        return suffix, confusible[:-len(suffix)] + self.suffixes[0]  #suffix, normalized
+        #no suffix matches: fall back to the last (shortest) suffix, as the original loop over all suffixes did
+        suffix = self.suffixes[-1]
+        result = (suffix, confusible[:-len(suffix)] + self.suffixes[0])
+        self.suffixindex[confusible] = result
+        return result
 
 
 
     def classify(self, features):
+        features = tuple(features) #may be a list when passed by the client
+        try:
+            return self.cache[features] #contexts recur a lot, the same features need not be classified again
+        except KeyError:
+            pass
+        result = self.classifyuncached(features)
+        self.cache.append(features, result)
+        return result
+
+    def classifyuncached(self, features):
         if self.hapaxer: features = self.hapaxer(features)
         best,distribution,_ = self.classifier.classify(features)
         sumweights = sum(distribution.values())
-        if sumweights < self.settings['minocc']:
+        if sumweights < self.minocc:
             return best, []
-        distribution = { sug: weight/sumweights for sug,weight in distribution.items() if weight/sumweights >= self.settings['threshold'] }
+        threshold = self.threshold
+        distribution = { sug: p for sug, p in ( (sug, weight/sumweights) for sug,weight in distribution.items() ) if p >= threshold } #each weight is normalised only once
         if self.debug: self.log("(Returning " + str(len(distribution)) + " suggestions after filtering)")
         return (best,distribution)
 
-    def getfeatures(self, word):
-        """Get features at testing time, crosses sentence boundaries"""
-        leftcontext = tuple([ str(w) for w in word.leftcontext(self.settings['leftcontext'],"<begin>") ])
-        _, normalized = self.getsuffix(word.text())
-        rightcontext = tuple([ str(w) for w in word.rightcontext(self.settings['rightcontext'],"<end>") ])
+    def getfeatures(self, word, wordstr=None):
+        """Get features at testing time, crosses sentence boundaries. The text of the word may be passed if it is already known."""
+        leftcontext, rightcontext = self.getcontext(word)
+        _, normalized = self.getsuffix(word.text() if wordstr is None else wordstr)
         return leftcontext + (normalized,) + rightcontext
 
 
-    def prepareinput(self,word,**parameters):
+    def prepareinput(self,unit,**parameters):
         """Takes the specified FoLiA unit for the module, and returns a string that can be passed to process()"""
+        if self.UNIT is folia.Sentence:
+            #batch mode: (word_id, wordstr, features) for all confusibles in the sentence
+            inputdata = []
+            for word in unit.words():
+                wordinput = self.prepareword(word)
+                if wordinput is not None:
+                    inputdata.append( (word.id,) + wordinput )
+            return inputdata if inputdata else None
+        return self.prepareword(unit)
+
+    def prepareword(self, word):
+        if not self.UNITFILTER(word): #the word itself is filtered here in both modes, ProcessorThread only gets to see the prepared input
+            return None
         wordstr = str(word)
         try:
-            if wordstr in self.confusibles:
-                features = self.getfeatures(word)
+            if wordstr in self.confusibleset:
+                features = self.getfeatures(word, wordstr)
                 return wordstr, features
         except AttributeError:
             self.log("No confusibles have been loaded! Unable to prepare input!")
 
     def run(self, inputdata):
         """This method gets called by the module's server and handles a message by the client. The return value (str) is returned to the client"""
+        if self.UNIT is folia.Sentence:
+            return [ self.classify(features) for _, _, features in inputdata ]
         _,features = inputdata
         best,distribution = self.classify(features)
         return (best,distribution)
 
     def processoutput(self, output, inputdata, unit_id,**parameters):
+        if self.UNIT is folia.Sentence:
+            return [ query for query in ( self.processword(wordoutput, wordstr, word_id) for (word_id, wordstr, _), wordoutput in zip(inputdata, output) ) if query is not None ]
         wordstr,_ = inputdata
+        return self.processword(output, wordstr, unit_id)
+
+    def processword(self, output, wordstr, word_id):
         best,distribution = output
         suffix,_ = self.getsuffix(wordstr)
-        if wordstr != wordstr[:-len(suffix)] + best:
-            return self.addsuggestions(unit_id, [ (wordstr[:-len(suffix)] + suggestion,p) for suggestion,p in distribution.items() if suggestion != suffix] )
+        if best == suffix or not distribution:
+            return None #the common case: the suffix as written is the best one, nothing to suggest
+        stem = wordstr[:-len(suffix)]
+        suggestions = [ (stem + suggestion,p) for suggestion,p in distribution.items() if suggestion != suffix]
+        if suggestions:
+            return self.addsuggestions(word_id, suggestions)
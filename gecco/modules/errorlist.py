@@ -12,9 +12,24 @@
 
 import sys
 import os
+import mmap
+import pickle
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 import folia.main as folia
 from gecco.gecco import Module
 from gecco.helpers.filters import hasalpha
+try:
+    import marisa_trie #pylint: disable=import-error
+except ImportError:
+    marisa_trie = None #optional, only needed for the trie setting
+
+_loadmodule = None #module loading model files, inherited by forked worker processes
+
+def _loadmodel(modelfile):
+    return _loadmodule.loadmodel(modelfile)
+
+DELIMITERS = {'space': " ", 'tab': "\t", 'tilde': "~", 'comma': ","} #names that may be used for the delimiter setting
 
 class WordErrorListModule(Module):
     """Lexicon Module. Checks an input word against a lexicon and returns suggestions with a certain Levensthein distance. The lexicon may be automatically compiled from a corpus.
@@ -25,6 +40,12 @@ class WordErrorListModule(Module):
     * ``reversedformat``     - Set to true if the model has correct->wrong pairs rather than wrong->correct pairs (default: False)
 
     * ``class``        - Errors found by this module will be assigned the specified class in the resulting FoLiA output (default: nonworderror)
+    * ``codec``        - Serialisation used between client and server: ``msgpack`` (compact binary, default if msgpack is installed) or ``json``
+    * ``batch``        - Process whole sentences rather than single words, so each sentence takes a single call (and server round-trip) (default: False)
+    * ``loadprocesses`` - The number of processes used to parse multiple model files in parallel (default: 1)
+    * ``modelcache``   - Keep a pickled copy of each parsed model file (``<model>.pickle``) and load that instead as long as the model file is unchanged, speeds up loading large error lists. Only enable this if the cache files can be trusted! (default: False)
+    * ``trie``         - Store the error list in a compact static trie rather than a dictionary, reduces memory usage for very large error lists (default: False, requires marisa-trie).
+                         If ``modelcache`` is enabled as well, the trie is saved (``<firstmodel>.marisa``) and memory mapped, so multiple servers on the same host share it. It is rebuilt when a model file is newer, or when the model files, ``delimiter`` or ``reversedformat`` changed.
 
     Models:
     * An error list   (manually compiled, not trainable from source)
@@ -37,15 +58,8 @@ class WordErrorListModule(Module):
 
         if 'delimiter' not in self.settings or not self.settings['delimiter']:
             self.settings['delimiter'] = "\t"
-
-        if self.settings['delimiter'].lower() == 'space':
-            self.settings['delimiter'] = " "
-        elif self.settings['delimiter'].lower() == 'tab':
-            self.settings['delimiter'] = "\t"
-        elif self.settings['delimiter'].lower() == 'tilde':
-            self.settings['delimiter'] = "~"
-        elif self.settings['delimiter'].lower() == 'comma':
-            self.settings['delimiter'] = ","
+        else:
+            self.settings['delimiter'] = DELIMITERS.get(self.settings['delimiter'].lower(), self.settings['delimiter'])
 
         if 'class' not in self.settings:
             self.settings['class'] = 'nonworderror'
@@ -53,6 +67,22 @@ class WordErrorListModule(Module):
         if 'reversedformat' not in self.settings: #reverse format has (correct,wrong) pairs rather than (wrong,correct) pairs
             self.settings['reversedformat'] = False
 
+        self.setcodec()
+
+        if 'batch' in self.settings and self.settings['batch']:
+            self.UNIT = folia.Sentence #all words in a sentence are looked up in one go
+
+        if 'loadprocesses' not in self.settings:
+            self.settings['loadprocesses'] = 1
+
+        if 'modelcache' not in self.settings:
+            self.settings['modelcache'] = False
+
+        if 'trie' not in self.settings:
+            self.settings['trie'] = False
+        elif self.settings['trie'] and marisa_trie is None:
+            raise Exception("The trie setting requires the marisa_trie module, which is not installed")
+
     def load(self):
         """Load the requested modules from self.models"""
         self.errorlist = {}
@@ -63,44 +93,152 @@ class WordErrorListModule(Module):
         for modelfile in self.models:
             if not os.path.exists(modelfile):
                 raise IOError("Missing expected model file:" + modelfile)
-            self.log("Loading model file " + modelfile)
-            with open(modelfile,'r',encoding='utf-8') as f:
-                for line in f:
+
+        if self.settings['trie'] and self.settings['modelcache']:
+            triefile = self.models[0] + ".marisa"
+            if os.path.exists(triefile) and os.path.exists(triefile + ".key") and all( os.path.getmtime(triefile) >= os.path.getmtime(modelfile) for modelfile in self.models ):
+                with open(triefile + ".key",'rb') as f:
+                    cachedkey = pickle.load(f)
+                if cachedkey == self.triekey():
+                    self.log("Loading trie " + triefile)
+                    self.maptrie(triefile)
+                    return
+                self.log("Trie " + triefile + " was built from other model files or settings")
+
+        for errorlist in self.loadmodels():
+            if not self.errorlist:
+                self.errorlist = errorlist
+                continue
+            for wrong, suggestions in errorlist.items():
+                current = self.errorlist.get(wrong)
+                self.errorlist[wrong] = suggestions if current is None else current + "\t" + suggestions
+
+        if self.settings['trie']:
+            self.errorlist = marisa_trie.BytesTrie( (wrong, suggestions.encode('utf-8')) for wrong, suggestions in self.errorlist.items() )
+            if self.settings['modelcache']:
+                #save the trie and use it memory mapped, so all server processes on this host share the same pages
+                triefile = self.models[0] + ".marisa"
+                try:
+                    self.errorlist.save(triefile)
+                    with open(triefile + ".key",'wb') as f:
+                        pickle.dump(self.triekey(), f, protocol=pickle.HIGHEST_PROTOCOL)
+                except OSError:
+                    self.log("WARNING: Unable to write trie " + triefile)
+                else:
+                    self.maptrie(triefile)
+
+    def triekey(self):
+        """The model files and parse settings a saved trie was built from, it is only reused if these are unchanged"""
+        return (tuple(self.models), self.settings['delimiter'], self.settings['reversedformat'])
+
+    def maptrie(self, triefile):
+        self.errorlist = marisa_trie.BytesTrie()
+        self.errorlist.mmap(triefile)
+
+    def loadmodels(self):
+        """Yields the error list of each model file, in order. Multiple model files are loaded in parallel if loadprocesses is set."""
+        global _loadmodule #pylint: disable=global-statement
+        processes = min(self.settings['loadprocesses'], len(self.models))
+        if processes <= 1:
+            for modelfile in self.models:
+                self.log("Loading model file " + modelfile)
+                yield self.loadmodel(modelfile)
+        else:
+            self.log("Loading " + str(len(self.models)) + " model files in " + str(processes) + " processes")
+            _loadmodule = self
+            try:
+                #fork so workers inherit the module without pickling
+                with ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context('fork')) as executor:
+                    for errorlist in executor.map(_loadmodel, self.models):
+                        yield self.intern(errorlist) #strings passed back from the workers are no longer interned
+            finally:
+                _loadmodule = None #also when loading fails
+
+    def loadmodel(self, modelfile):
+        """Returns the error list in the specified model file as a dictionary, taken from the pickled cache file if enabled and up to date"""
+        if not self.settings['modelcache']:
+            return self.readmodel(modelfile)
+
+        cachefile = modelfile + ".pickle"
+        stat = os.stat(modelfile)
+        key = (stat.st_mtime_ns, stat.st_size, self.settings['delimiter'], self.settings['reversedformat'])
+        if os.path.exists(cachefile):
+            with open(cachefile,'rb') as f:
+                cachedkey, errorlist = pickle.load(f)
+            if cachedkey == key:
+                return self.intern(errorlist) #unpickled strings are not interned
+            self.log("Cache file " + cachefile + " is out of date")
+
+        errorlist = self.readmodel(modelfile)
+        try:
+            with open(cachefile,'wb') as f:
+                pickle.dump((key, errorlist), f, protocol=pickle.HIGHEST_PROTOCOL)
+        except OSError:
+            self.log("WARNING: Unable to write cache file " + cachefile)
+        return errorlist
+
+    def intern(self, errorlist):
+        """Returns the error list with all strings interned, as readmodel() returns it"""
+        return { sys.intern(wrong): sys.intern(suggestions) for wrong, suggestions in errorlist.items() }
+
+    def readmodel(self, modelfile):
+        """Parses the specified model file and returns the error list as a dictionary"""
+        errorlist = {}
+        with open(modelfile,'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return errorlist #empty files can not be mapped
+            #the file is memory mapped and parsed as bytes, only the fields themselves are decoded
+            delimiter = self.settings['delimiter'].encode('utf-8')
+            reversedformat = self.settings['reversedformat']
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                if mm.find(b"\r") == -1:
+                    lines = iter(mm.readline, b"")
+                else:
+                    lines = mm[:].splitlines() #\r or \r\n line endings, which readline() does not split on
+                for line in lines:
                     if line.strip():
-                        fields = [ x.strip() for x in line.split(self.settings['delimiter']) ]
-                        if  len(fields) != 2:
-                            raise Exception("Syntax error in " + modelfile + ", expected two items, got " + str(len(fields)))
+                        left, sep, right = line.partition(delimiter) #exactly two fields, no need for a list
+                        if not sep or delimiter in right:
+                            raise Exception("Syntax error in " + modelfile + ", expected two items, got " + str(len(line.split(delimiter))))
 
-                        if self.settings['reversedformat']:
-                            correct, wrong = fields
+                        #interned, corrections in particular recur for many different errors
+                        if reversedformat:
+                            correct, wrong = sys.intern(left.decode('utf-8').strip()), sys.intern(right.decode('utf-8').strip())
                         else:
-                            wrong, correct = fields
-
-                        if wrong in self.errorlist:
-                            current = self.errorlist[wrong]
-                            if isinstance(current, tuple):
-                                self.errorlist[wrong] = current + (correct,)
-                            else:
-                                self.errorlist[wrong] = (current, correct)
-                        else:
-                            self.errorlist[wrong] = correct
+                            wrong, correct = sys.intern(left.decode('utf-8').strip()), sys.intern(right.decode('utf-8').strip())
 
-    def prepareinput(self,word,**parameters):
-        """Takes the specified FoLiA unit for the module, and returns a string that can be passed to process()"""
-        return str(word)
+                        current = errorlist.get(wrong)
+                        errorlist[wrong] = correct if current is None else current + "\t" + correct #multiple suggestions are stored tab-joined, as returned by run()
+        return errorlist
 
-    def processoutput(self, response, wordstr, unit_id, **parameters):
-        if response != wordstr: #server will echo back the same thing if it's not in the error list
+    def prepareinput(self,unit,**parameters):
+        """Takes the specified FoLiA unit for the module, and returns a string that can be passed to process()"""
+        if self.UNIT is folia.Sentence:
+            #batch mode: (word_id, wordstr) for all words in the sentence
+            inputdata = [ (word.id, wordstr) for word, wordstr in ( (word, str(word)) for word in unit.words() ) if self.UNITFILTER(wordstr) ]
+            return inputdata if inputdata else None
+        return str(unit)
+
+    def processoutput(self, response, inputdata, unit_id, **parameters):
+        if self.UNIT is folia.Sentence:
+            #batch mode: the server only returns (word_id, suggestions) for words in the error list
+            return [ self.addsuggestions(word_id, suggestions.split("\t")) for word_id, suggestions in response ]
+        if response != inputdata: #server will echo back the same thing if it's not in the error list
             suggestions = response.split("\t")
             return self.addsuggestions(unit_id, suggestions)
 
-    def run(self, word):
+    def run(self, inputdata):
         """This method gets called by the module's server and handles a message by the client. The return value (str) is returned to the client"""
-        if word in self.errorlist:
-            suggestions = self.errorlist[word]
-            if isinstance(suggestions, str):
-                return suggestions
-            else:
-                return "\t".join(suggestions)
-        else:
-            return word   #server will echo back the same thing if it's not in the error list
+        if self.UNIT is folia.Sentence:
+            return [ (word_id, suggestions) for word_id, suggestions in ( (word_id, self.lookup(wordstr)) for word_id, wordstr in inputdata ) if suggestions is not None ]
+        suggestions = self.lookup(inputdata)
+        if suggestions is None:
+            return inputdata   #server will echo back the same thing if it's not in the error list
+        return suggestions
+
+    def lookup(self, word):
+        """Returns the tab-joined suggestions for the word, or None if it is not in the error list"""
+        suggestions = self.errorlist.get(word)
+        if isinstance(suggestions, list): #trie
+            return suggestions[0].decode('utf-8')
+        return suggestions
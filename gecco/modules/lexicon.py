@@ -12,10 +12,20 @@
 
 #pylint: disable=too-many-nested-blocks,attribute-defined-outside-init
 
+import sys
 import os
+import bisect
+import heapq
+import operator
+import pickle
 import folia.main as folia
 #from pynlpl.statistics import levenshtein
 import Levenshtein #pylint: disable=import-error
+try:
+    from rapidfuzz.distance import Levenshtein as RapidLevenshtein #pylint: disable=import-error
+    from rapidfuzz import process as rapidprocess #pylint: disable=import-error
+except ImportError:
+    RapidLevenshtein = rapidprocess = None #optional, faster bounded distance computation
 from gecco.gecco import Module
 from gecco.helpers.caching import getcache
 from gecco.helpers.filters import hasalpha
@@ -24,6 +34,26 @@ import colibricore #pylint: disable=import-error
 import aspell #pylint: disable=import-error
 import hunspell #pylint: disable=import-error
 
+if RapidLevenshtein is not None:
+    def levenshtein(s, t, maxdistance):
+        """Returns the Levenshtein distance between s and t, or any value larger than maxdistance if it exceeds maxdistance (computation stops early then)"""
+        return RapidLevenshtein.distance(s, t, score_cutoff=maxdistance)
+
+    def withindistance(word, candidates, maxdistance):
+        """Yields (index, distance) pairs for all candidates within maxdistance of the word, in order. The candidates are compared in a single call, rather than one call per candidate"""
+        for _, ld, index in rapidprocess.extract_iter(word, candidates, scorer=RapidLevenshtein.distance, processor=None, score_cutoff=maxdistance): #no preprocessing, older versions lowercase and strip by default
+            yield index, ld
+else:
+    def levenshtein(s, t, maxdistance): #pylint: disable=unused-argument
+        """Returns the Levenshtein distance between s and t"""
+        return Levenshtein.distance(s, t)
+
+    def withindistance(word, candidates, maxdistance):
+        """Yields (index, distance) pairs for all candidates within maxdistance of the word, in order"""
+        for index, candidate in enumerate(candidates):
+            ld = Levenshtein.distance(word, candidate)
+            if ld <= maxdistance:
+                yield index, ld
 
 class LexiconModule(Module):
     """Lexicon Module. Checks an input word against a lexicon and returns suggestions with a certain Levensthein distance. The lexicon may be automatically compiled from a corpus.
@@ -40,15 +70,19 @@ class LexiconModule(Module):
 
     * ``delimiter``    - The delimiter between the frequency and the word in the model file, may be 'space', 'tab' (default), 'comma'.
     * ``reversed``     - Set to true if the model has word,freq pairs rather than freq,word pairs (default: False)
-    * ``ordered``      - Indicates that the model file is ordered by frequency (descending) (default: True) -  Not using ordering decreases performance!
+    * ``ordered``      - Indicates that the model file is ordered by frequency (descending) (default: True) -  Not using ordering decreases performance! Only if set explicitly, loading stops at the first word below ``minfreqthreshold``
+    * ``modelcache``   - Keep a pickled copy of each parsed model file (``<model>.pickle``) and load that instead as long as the model file and the settings above are unchanged, speeds up loading large lexicons. Only enable this if the cache files can be trusted! (default: False)
 
     * ``suffixes``     - A list of suffixes that will be stripped from a word in case of a mismatch, after which the remainder is rematched against the lexicon
     * ``prefixes``     - A list of prefixes that will be stripped from a word in case of a mismatch, after which the remainder is rematched against the lexicon
 
     * ``class``        - Errors found by this module will be assigned the specified class in the resulting FoLiA output (default: contexterror)
+    * ``batch``        - Process whole sentences rather than single words, so each sentence takes a single call (and server round-trip) (default: False)
 
     Sources and models:
     * a plain-text corpus (tokenized)  [``.txt``]     ->    a lexicon [``.txt``]
+
+    Caching: This module supports caching, suggestions are cached per word. Use ``cachetype: lru`` to keep recurring words cached longer than with the default first-in-first-out cache
     """
     UNIT = folia.Word
     UNITFILTER = hasalpha
@@ -70,8 +104,13 @@ class LexiconModule(Module):
         if 'reversedformat' not in self.settings: #reverse format has (word,freq) pairs rather than (freq,word) pairs
             self.settings['reversedformat'] = False
 
-        if 'ordered ' not in self.settings:
+        if 'ordered' not in self.settings:
             self.settings['ordered'] = True #Model file is ordered in descending frequency
+            self.stopearly = False #but the whole model file is read, unless the ordering was configured explicitly
+        else:
+            self.stopearly = bool(self.settings['ordered'])
+        if 'modelcache' not in self.settings:
+            self.settings['modelcache'] = False
 
 
         if 'freqthreshold' not in self.settings:
@@ -93,12 +132,17 @@ class LexiconModule(Module):
         if 'maxnrclosest' not in self.settings:
             self.settings['maxnrclosest'] = 5
 
-        self.cache = getcache(self.settings, 1000) #2nd arg is default cache size
+        self.cache = getcache(self.settings, 100000) #2nd arg is default cache size
+
+        if 'batch' in self.settings and self.settings['batch']:
+            self.UNIT = folia.Sentence #all words in a sentence are checked in one go
 
         if 'suffixes' not in self.settings:
             self.settings['suffixes'] = []
         if 'prefixes' not in self.settings:
             self.settings['prefixes'] = []
+        self.suffixes = tuple(self.settings['suffixes']) #so all suffixes can be tested with a single endswith()
+        self.prefixes = tuple(self.settings['prefixes']) #so all prefixes can be tested with a single startswith()
 
 
 
@@ -138,16 +182,18 @@ class LexiconModule(Module):
     def savemodel(self, model, modelfile, classfile):
         self.log("Saving model")
         classdecoder = colibricore.ClassDecoder(classfile)
-        with open(modelfile,'w',encoding='utf-8') as f:
+        delimiter = self.settings['delimiter']
+        reversedformat = self.settings['reversedformat']
+        with open(modelfile,'w',encoding='utf-8', buffering=1024*1024) as f:
             if self.settings['ordered']:
-                items = sorted(model.items(), key=lambda x: -1 * x[1])
+                items = sorted(model.items(), key=operator.itemgetter(1), reverse=True) #no lambda call per item
             else:
                 items = model.items()
             for pattern, occurrencecount in items:
-                if self.settings['reversedformat']:
-                    f.write(str(occurrencecount) + self.settings['delimiter'] + pattern.tostring(classdecoder) + "\n")
+                if reversedformat:
+                    f.write(str(occurrencecount) + delimiter + pattern.tostring(classdecoder) + "\n")
                 else:
-                    f.write(pattern.tostring(classdecoder) + self.settings['delimiter'] + str(occurrencecount) + "\n")
+                    f.write(pattern.tostring(classdecoder) + delimiter + str(occurrencecount) + "\n")
 
     def load(self):
         """Load the requested modules from self.models"""
@@ -160,23 +206,81 @@ class LexiconModule(Module):
             if not os.path.exists(modelfile):
                 raise IOError("Missing expected model file:" + modelfile)
             self.log("Loading model file " + modelfile)
-            with open(modelfile,'r',encoding='utf-8') as f:
-                for line in f:
-                    if line.strip():
-                        fields = [ x.strip() for x in line.split(self.settings['delimiter']) ]
-                        if  len(fields) != 2:
-                            raise Exception("Syntax error in " + modelfile + ", expected two items, got " + str(len(fields)))
-
-                        if self.settings['reversedformat']:
-                            freq, word = fields
-                        else:
-                            word, freq = fields
-                        freq = int(freq)
-
-                        if freq > self.settings['minfreqthreshold']:
-                            self.lexicon[word] = freq
-
-    def __exists__(self, word):
+            self.lexicon.update(self.loadmodel(modelfile))
+
+        self.buildlengthindex()
+
+    def loadmodel(self, modelfile):
+        """Returns the lexicon in the specified model file as a dictionary, taken from the pickled cache file if enabled and up to date"""
+        if not self.settings['modelcache']:
+            return self.readmodel(modelfile)
+
+        cachefile = modelfile + ".pickle"
+        stat = os.stat(modelfile)
+        key = (stat.st_mtime_ns, stat.st_size, self.settings['delimiter'], self.settings['reversedformat'], self.stopearly, self.settings['minfreqthreshold'])
+        if os.path.exists(cachefile):
+            with open(cachefile,'rb') as f:
+                cachedkey, lexicon = pickle.load(f)
+            if cachedkey == key:
+                return { sys.intern(word): freq for word, freq in lexicon.items() } #unpickled strings are not interned
+            self.log("Cache file " + cachefile + " is out of date")
+
+        lexicon = self.readmodel(modelfile)
+        try:
+            with open(cachefile,'wb') as f:
+                pickle.dump((key, lexicon), f, protocol=pickle.HIGHEST_PROTOCOL)
+        except OSError:
+            self.log("WARNING: Unable to write cache file " + cachefile)
+        return lexicon
+
+    def readmodel(self, modelfile):
+        """Parses the specified model file and returns the lexicon as a dictionary"""
+        lexicon = {}
+        #read as bytes through a large buffer, only the word itself is decoded (int() takes bytes directly)
+        delimiter = self.settings['delimiter'].encode('utf-8')
+        reversedformat = self.settings['reversedformat']
+        stopearly = self.stopearly
+        minfreqthreshold = self.settings['minfreqthreshold']
+        prevfreq = None
+        with open(modelfile,'rb', buffering=1024*1024) as f:
+            for line in f:
+                if line.strip():
+                    left, sep, right = line.partition(delimiter) #exactly two fields, no need for a list
+                    if not sep or delimiter in right:
+                        raise Exception("Syntax error in " + modelfile + ", expected two items, got " + str(len(line.split(delimiter))))
+
+                    if reversedformat:
+                        freq, word = int(left), right.decode('utf-8').strip()
+                    else:
+                        word, freq = left.decode('utf-8').strip(), int(right)
+
+                    if stopearly:
+                        if prevfreq is not None and freq > prevfreq:
+                            self.log("WARNING: Model file " + modelfile + " is not ordered by descending frequency, reading all of it")
+                            stopearly = False
+                        prevfreq = freq
+
+                    if freq > minfreqthreshold:
+                        lexicon[sys.intern(word)] = freq #interned, like the tokens of SentenceContext, so equal words share one object
+                    elif stopearly:
+                        break #ordered by descending frequency, the remainder is below the threshold too
+        return lexicon
+
+    def buildlengthindex(self):
+        """Groups the lexicon by word length, so only words of a length within the maximum distance need to be considered when looking for the closest matches. Each group is sorted by descending frequency and holds two parallel lists: the words and their negated frequencies (ascending, so a frequency threshold can be found by bisection)."""
+        groups = {}
+        for key, freq in self:
+            try:
+                groups[len(key)].append( (key, freq) )
+            except KeyError:
+                groups[len(key)] = [ (key, freq) ]
+        self.lengthindex = {} #pylint: disable=attribute-defined-outside-init
+        for length, entries in groups.items():
+            entries.sort(key=lambda x: -1 * x[1]) #stable, so equally frequent words keep the lexicon order
+            self.lengthindex[length] = ( [ key for key, _ in entries ], [ -1 * freq for _, freq in entries ] ) #no tuple per entry is kept
+        self.maxfreq = max( (-1 * negfreqs[0] for _, negfreqs in self.lengthindex.values()), default=0) #pylint: disable=attribute-defined-outside-init
+
+    def __contains__(self, word):
         return word in self.lexicon
 
     def __iter__(self):
@@ -199,63 +303,84 @@ class LexiconModule(Module):
             return 0
 
     def findclosest(self, word):
-        #first try the cache
-        if self.cache:
-            try:
-                return self.cache[word]
-            except KeyError:
-                pass
+        #first try the cache (cached results are always lists, so None means a miss)
+        cache = self.cache
+        results = cache.get(word)
+        if results is not None:
+            return results
 
+        settings = self.settings #local, saves attribute lookups
         l = len(word)
-        if l < self.settings['minlength'] or l > self.settings['maxlength']:
+        if l < settings['minlength'] or l > settings['maxlength']:
             #word too long or too short, ignore
             return False
         else:
             freq = self[word]
 
             #but first try to strip known suffixes and prefixes and try again
-            for suffix in self.settings['suffixes']:
-                if word.endswith(suffix):
-                    if word[:-len(suffix)] in self:
-                        freq = max(self[word[:-len(suffix)]], freq)
-            for prefix in self.settings['prefixes']:
-                if word.beginswith(prefix):
-                    if word[len(prefix):] in self:
-                        freq = max(self[word[len(prefix):]], freq)
+            if word.endswith(self.suffixes):
+                for suffix in self.suffixes:
+                    if word.endswith(suffix):
+                        if word[:-len(suffix)] in self:
+                            freq = max(self[word[:-len(suffix)]], freq)
+            if word.startswith(self.prefixes):
+                for prefix in self.prefixes:
+                    if word.startswith(prefix):
+                        if word[len(prefix):] in self:
+                            freq = max(self[word[len(prefix):]], freq)
 
             #find closest matches *above threshold* by levenshtein distance
 
             results = []
-            isshort = (len(word) <= self.settings['shortlength'])
-            for key, freq in self.filter(freq*self.settings['freqfactor']):
-                #ld = levenshtein(word, key, self.settings['maxdistance'])
-                if isshort:
-                    if abs(l - len(key)) <= self.settings['maxdistance_short']:
-                        ld = Levenshtein.distance(word,key)
-                        if ld <= self.settings['maxdistance_short']:
-                            results.append( (key, ld) )
-                else:
-                    if abs(l - len(key)) <= self.settings['maxdistance']:
-                        ld = Levenshtein.distance(word,key)
-                        if ld <= self.settings['maxdistance']:
-                            results.append( (key, ld) )
-
-            results.sort(key=lambda x: x[1])
-            results = results[:self.settings['maxnrclosest']]
-            self.cache.append(word, results)
+            freqthreshold = max(freq*settings['freqfactor'], settings['minfreqthreshold'])
+            if freqthreshold > self.maxfreq:
+                #no word in the lexicon is frequent enough, the common case for correctly spelled words
+                cache.append(word, results)
+                return results
+            isshort = (l <= settings['shortlength'])
+            maxdistance = settings['maxdistance_short'] if isshort else settings['maxdistance']
+            lengthindex = self.lengthindex
+            for length in range(l - maxdistance, l + maxdistance + 1): #words differing more in length can not be within maxdistance
+                if length not in lengthindex:
+                    continue
+                keys, negfreqs = lengthindex[length]
+                end = bisect.bisect_right(negfreqs, -1 * freqthreshold) #sorted by descending frequency, all words from here on are below the threshold
+                for index, ld in withindistance(word, keys[:end], maxdistance):
+                    results.append( (keys[index], ld, negfreqs[index]) )
+
+            #the closest by distance, then by frequency, as a scan over the (ordered) lexicon would have found them; only these are sorted
+            results = [ (key, ld) for key, ld, _ in heapq.nsmallest(settings['maxnrclosest'], results, key=operator.itemgetter(1,2)) ]
+            cache.append(word, results)
             return results
 
 
-    def prepareinput(self,word,**parameters):
+    def prepareinput(self,unit,**parameters):
         """Takes the specified FoLiA unit for the module, and returns a string that can be passed to process()"""
-        return '!' + str(word) #! is the command to return closest suggestions if the word is not in the lexicon, ? merely return a boolean whether the word is in lexicon or not
+        if self.UNIT is folia.Sentence:
+            #batch mode: (word_ids, wordstr) for all distinct words in the sentence, so repeated words are sent and checked only once
+            word_ids = {}
+            for word in unit.words():
+                wordstr = str(word)
+                if self.UNITFILTER(wordstr):
+                    word_ids.setdefault(wordstr, []).append(word.id)
+            return [ (ids, wordstr) for wordstr, ids in word_ids.items() ] if word_ids else None
+        return '!' + str(unit) #! is the command to return closest suggestions if the word is not in the lexicon, ? merely return a boolean whether the word is in lexicon or not
 
 
     def processoutput(self, output,inputdata, unit_id,**parameters):
+        if self.UNIT is folia.Sentence:
+            #batch mode: the server only returns (word_ids, results) for words with suggestions
+            queries = []
+            for word_ids, results in output:
+                suggestions = [ result for result,distance in results ]
+                queries += [ self.addsuggestions(word_id, suggestions) for word_id in word_ids ]
+            return queries
         return self.addsuggestions(unit_id, [ result for result,distance in output ] )
 
     def run(self, inputdata):
         """This methods gets called by the module's server and handles a message by the client. The return value (str) is returned to the client"""
+        if self.UNIT is folia.Sentence:
+            return [ (word_ids, results) for word_ids, results in ( (word_ids, self.findclosest(wordstr)) for word_ids, wordstr in inputdata ) if results ]
         if inputdata:
             command = inputdata[0]
             word = inputdata[1:]
@@ -285,8 +410,9 @@ class ColibriLexiconModule(LexiconModule):
         self.classencoder = colibricore.ClassEncoder(modelfile + '.cls')
         self.classdecoder = colibricore.ClassDecoder(modelfile + '.cls')
         self.lexicon = colibricore.UnindexedPatternModel(modelfile)
+        self.buildlengthindex()
 
-    def __exists__(self, word):
+    def __contains__(self, word):
         pattern = self.classencoder.buildpattern(word)
         if pattern.unknown():
             return False
@@ -341,19 +467,41 @@ class ExternalSpellModule(Module):
             self.settings['suffixes'] = []
         if 'prefixes' not in self.settings:
             self.settings['prefixes'] = []
+        self.suffixes = tuple(self.settings['suffixes']) #so all suffixes can be tested with a single endswith()
+        self.prefixes = tuple(self.settings['prefixes']) #so all prefixes can be tested with a single startswith()
+
+        self.cache = getcache(self.settings, 100000) #2nd arg is default cache size
 
-        self.cache = getcache(self.settings, 1000) #2nd arg is default cache size
+        if 'batch' in self.settings and self.settings['batch']:
+            self.UNIT = folia.Sentence #all words in a sentence are checked in one go
 
-    def prepareinput(self,word,**parameters):
+    def prepareinput(self,unit,**parameters):
         """Takes the specified FoLiA unit for the module, and returns a string that can be passed to process()"""
+        if self.UNIT is folia.Sentence:
+            #batch mode: (word_ids, wordstr) for all distinct words in the sentence, so repeated words are sent and checked only once
+            word_ids = {}
+            for word in unit.words():
+                wordstr = self.prepareword(word)
+                if wordstr is not None:
+                    word_ids.setdefault(wordstr, []).append(word.id)
+            return [ (ids, wordstr) for wordstr, ids in word_ids.items() ] if word_ids else None
+        return self.prepareword(unit)
+
+    def prepareword(self, word):
         wordstr = str(word)
         l = len(wordstr)
-        if l < self.settings['minlength'] or l > self.settings['maxlength']:
+        if l < self.settings['minlength'] or l > self.settings['maxlength'] or not self.UNITFILTER(wordstr):
             return None
         else:
             return wordstr
 
     def processoutput(self, output, inputdata, unit_id,**parameters):
+        if self.UNIT is folia.Sentence:
+            #batch mode: the server only returns (word_ids, results) for words with suggestions
+            return [ query for word_ids, results in output for word_id in word_ids for query in self.processword(results, word_id) ]
+        return self.processword(output, unit_id)
+
+    def processword(self, output, unit_id):
         queries = []
         if output:
             queries.append( self.addsuggestions(unit_id, [ (word,confidence) for word,confidence in output if ' ' not in word]) )
@@ -367,30 +515,36 @@ class ExternalSpellModule(Module):
             return queries
 
 
-    def run(self, word):
+    def run(self, inputdata):
         """This methods gets called by the module's server and handles a message by the client. The return value (str) is returned to the client"""
-        if self.cache:
-            try:
-                return self.cache[word]
-            except KeyError:
-                pass
+        if self.UNIT is folia.Sentence:
+            return [ (word_ids, results) for word_ids, results in ( (word_ids, self.checkword(wordstr)) for word_ids, wordstr in inputdata ) if results ]
+        return self.checkword(inputdata)
+
+    def checkword(self, word):
+        """Returns the closest suggestions for the word, or an empty list if it is correct"""
+        results = self.cache.get(word) #cached results are always lists, so None means a miss
+        if results is not None:
+            return results
         suggestions = self[word]
         if word not in suggestions:
             #try to strip known suffixes and prefixes and try again
-            for suffix in self.settings['suffixes']:
-                if word.endswith(suffix):
-                    word2 = word[:-len(suffix)]
-                    suggestions2 = self[word2]
-                    if word2 in suggestions2:
-                        self.cache.append(word, [])
-                        return []
-            for prefix in self.settings['prefixes']:
-                if word.beginswith(prefix):
-                    word2 = word[len(prefix):]
-                    suggestions2 = self[word2]
-                    if word2 in suggestions2:
-                        self.cache.append(word, [])
-                        return []
+            if word.endswith(self.suffixes):
+                for suffix in self.suffixes:
+                    if word.endswith(suffix):
+                        word2 = word[:-len(suffix)]
+                        suggestions2 = self[word2]
+                        if word2 in suggestions2:
+                            self.cache.append(word, [])
+                            return []
+            if word.startswith(self.prefixes):
+                for prefix in self.prefixes:
+                    if word.startswith(prefix):
+                        word2 = word[len(prefix):]
+                        suggestions2 = self[word2]
+                        if word2 in suggestions2:
+                            self.cache.append(word, [])
+                            return []
             return self.findclosest(word,suggestions)
         else:
             self.cache.append(word, [])
@@ -402,24 +556,16 @@ class ExternalSpellModule(Module):
 
         results = []
         l = len(word)
-        isshort = (len(word) <= self.settings['shortlength'])
+        isshort = (l <= self.settings['shortlength'])
+        maxdistance = self.settings['maxdistance_short'] if isshort else self.settings['maxdistance'] #decided once, not per suggestion
         for sug in suggestions:
-            #ld = levenshtein(word, key, self.settings['maxdistance'])
-            if isshort:
-                if abs(l - len(sug)) <= self.settings['maxdistance_short']:
-                    ld = Levenshtein.distance(word,sug)
-                    if ld <= self.settings['maxdistance_short']:
-                        results.append( (sug, ld) )
-            else:
-                if abs(l - len(sug)) <= self.settings['maxdistance']:
-                    ld = Levenshtein.distance(word,sug)
-                    if ld <= self.settings['maxdistance']:
-                        results.append( (sug, ld) )
-
-        results.sort(key=lambda x: x[1])
-        results = results[:self.settings['maxnrclosest']]
-        if self.cache:
-            self.cache.append(word, results)
+            if abs(l - len(sug)) <= maxdistance:
+                ld = levenshtein(word,sug,maxdistance)
+                if ld <= maxdistance:
+                    results.append( (sug, ld) )
+
+        results = heapq.nsmallest(self.settings['maxnrclosest'], results, key=operator.itemgetter(1)) #only the closest are sorted
+        self.cache.append(word, results)
         return results
 
 class AspellModule(ExternalSpellModule):
@@ -436,6 +582,9 @@ class AspellModule(ExternalSpellModule):
     * ``maxnrclosest`` -  Limit the returned suggestions to this many items (default: 5)
     * ``suffixes``     - A list of suffixes that will be stripped from a word in case of a mismatch, after which the remainder is rematched against the lexicon
     * ``prefixes``     - A list of prefixes that will be stripped from a word in case of a mismatch, after which the remainder is rematched against the lexicon
+    * ``batch``        - Process whole sentences rather than single words, so each sentence takes a single call (and server round-trip) (default: False)
+
+    Caching: This module supports caching, suggestions are cached per word
     """
     UNIT = folia.Word
     UNITFILTER = hasalpha
@@ -473,6 +622,9 @@ class HunspellModule(ExternalSpellModule):
     * ``maxnrclosest`` -  Limit the returned suggestions to this many items (default: 5)
     * ``suffixes``     - A list of suffixes that will be stripped from a word in case of a mismatch, after which the remainder is rematched against the lexicon
     * ``prefixes``     - A list of prefixes that will be stripped from a word in case of a mismatch, after which the remainder is rematched against the lexicon
+    * ``batch``        - Process whole sentences rather than single words, so each sentence takes a single call (and server round-trip) (default: False)
+
+    Caching: This module supports caching, suggestions are cached per word
     """
 
     UNIT = folia.Word
@@ -1,5 +1,12 @@
 #!/bin/bash
 
+echo "Running unit tests of helpers and modules">&2
+python ./test_units.py
+if [ $? -ne 0 ]; then
+    echo "Unit tests failed!" >&2
+    exit 2
+fi
+
 if [ "$1" != "noreset" ]; then
     echo "Reset system">&2
     gecco test.yml reset
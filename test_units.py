@@ -0,0 +1,327 @@
+#!/usr/bin/env python3
+#Unit tests for helpers and module internals, these need no trained system (unlike test.py)
+import unittest
+import os
+import tempfile
+import gzip
+import bz2
+import socket
+import threading
+import folia.main as folia
+
+from gecco.modules.errorlist import WordErrorListModule
+from gecco.helpers.common import contextwindows, opensource, zstandard, SentenceContext
+from gecco.modules.confusibles import TIMBLWordConfusibleModule
+from gecco.gecco import FramedClient, FramedServerHandler, FRAMEHEADER, recvexactly, msgpack
+from gecco.modules.lexicon import LexiconModule, withindistance
+from gecco.helpers.caching import getcache, FIFOCache, LRUCache
+
+
+def writefile(filename, text):
+    with open(filename,'w',encoding='utf-8', newline='') as f: #line endings are written as given
+        f.write(text)
+    return filename
+
+
+class ErrorListTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def getmodule(self, modelfile, **settings):
+        return WordErrorListModule(None, id='errorlist', model=modelfile, logfunction=lambda x: None, **settings)
+
+    def test001_readmodel(self):
+        """Checking the error list parse, including duplicates, surrounding whitespace and a missing final newline"""
+        modelfile = writefile(os.path.join(self.tmpdir.name, "errors.txt"), "teh\tthe\nrecieve\treceive\n\n  teh \t tea \nwierd\tweird\nzeer\tzéér\nteh\tten")
+        self.assertEqual( self.getmodule(modelfile).readmodel(modelfile), {'teh': "the\ttea\tten", 'recieve': "receive", 'wierd': "weird", 'zeer': "zéér"} )
+        self.assertEqual( self.getmodule(modelfile, reversedformat=True).readmodel(modelfile), {'the': "teh", 'receive': "recieve", 'tea': "teh", 'weird': "wierd", 'zéér': "zeer", 'ten': "teh"} )
+
+    def test002_delimiter(self):
+        """Checking the error list parse with a named delimiter"""
+        modelfile = writefile(os.path.join(self.tmpdir.name, "errors.txt"), "teh the\nrecieve receive\n")
+        self.assertEqual( self.getmodule(modelfile, delimiter='space').readmodel(modelfile), {'teh': "the", 'recieve': "receive"} )
+
+    def test003_syntaxerror(self):
+        """Checking that lines with more or less than two fields are rejected"""
+        modelfile = writefile(os.path.join(self.tmpdir.name, "errors.txt"), "teh\tthe\ttea\n")
+        self.assertRaises( Exception, self.getmodule(modelfile).readmodel, modelfile )
+        modelfile = writefile(os.path.join(self.tmpdir.name, "errors2.txt"), "teh\n")
+        self.assertRaises( Exception, self.getmodule(modelfile).readmodel, modelfile )
+
+    def test004_empty(self):
+        """Checking that an empty error list can be read"""
+        modelfile = writefile(os.path.join(self.tmpdir.name, "errors.txt"), "")
+        self.assertEqual( self.getmodule(modelfile).readmodel(modelfile), {} )
+
+    def test005_crlf(self):
+        """Checking the error list parse of a file with CRLF line endings"""
+        modelfile = writefile(os.path.join(self.tmpdir.name, "errors.txt"), "teh\tthe\r\nrecieve\treceive\r\n\r\nteh\tten\r\n")
+        self.assertEqual( self.getmodule(modelfile).readmodel(modelfile), {'teh': "the\tten", 'recieve': "receive"} )
+
+    def test006_cr(self):
+        """Checking the error list parse of a file with CR line endings only"""
+        modelfile = writefile(os.path.join(self.tmpdir.name, "errors.txt"), "teh\tthe\rrecieve\treceive\r\rteh\tten")
+        self.assertEqual( self.getmodule(modelfile).readmodel(modelfile), {'teh': "the\tten", 'recieve': "receive"} )
+
+    def test007_modelcache(self):
+        """Checking that the pickled model cache is written and returns the same error list"""
+        modelfile = writefile(os.path.join(self.tmpdir.name, "errors.txt"), "teh\tthe\nteh\tten\n")
+        module = self.getmodule(modelfile, modelcache=True)
+        self.assertEqual( module.loadmodel(modelfile), {'teh': "the\tten"} )
+        self.assertTrue( os.path.exists(modelfile + ".pickle") )
+        self.assertEqual( module.loadmodel(modelfile), {'teh': "the\tten"} )
+
+    def test008_run(self):
+        """Checking that suggestions from multiple model files are joined"""
+        modelfile = writefile(os.path.join(self.tmpdir.name, "errors.txt"), "teh\tthe\n")
+        modelfile2 = writefile(os.path.join(self.tmpdir.name, "errors2.txt"), "teh\tten\nwierd\tweird\n")
+        module = self.getmodule([modelfile, modelfile2])
+        module.load()
+        self.assertEqual( module.run("teh"), "the\tten" )
+        self.assertEqual( module.run("wierd"), "weird" )
+        self.assertEqual( module.run("fine"), "fine" )
+
+
+class ContextWindowsTest(unittest.TestCase):
+    def test001_contextwindows(self):
+        """Checking the context windows of focus tokens, padded at the begin and end"""
+        tokens = "the cat sat on the mat".split()
+        self.assertEqual( list(contextwindows(tokens, 2, 1, {'the'})), [ (("<begin>","<begin>"), "the", ("cat",)), (("sat","on"), "the", ("mat",)) ] )
+        self.assertEqual( list(contextwindows(tokens, 1, 2, {'cat','mat'})), [ (("the",), "cat", ("sat","on")), (("the",), "mat", ("<end>","<end>")) ] )
+        self.assertEqual( list(contextwindows(tokens, 0, 0, {'sat'})), [ ((), "sat", ()) ] )
+
+    def test002_nofocus(self):
+        """Checking that no windows are produced when nothing is in focus"""
+        self.assertEqual( list(contextwindows("the cat sat".split(), 1, 1, {'dog'})), [] )
+
+    def test003_contextmap(self):
+        """Checking that contextwindows maps the context but not the focus"""
+        upper = lambda tokens: [ token.upper() for token in tokens ]
+        self.assertEqual( list(contextwindows("the cat sat on".split(), 1, 1, {'sat'}, contextmap=upper)), [ (("CAT",), "sat", ("ON",)) ] )
+
+
+class OpenSourceTest(unittest.TestCase):
+    TEXT = "the first line\nde tweede regel\n\nzäh\n"
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def check(self, filename):
+        with opensource(filename) as f:
+            self.assertEqual( list(f), ["the first line\n", "de tweede regel\n", "\n", "zäh\n"] )
+
+    def test001_plain(self):
+        """Checking opensource on a plain text source"""
+        self.check( writefile(os.path.join(self.tmpdir.name, "source.txt"), self.TEXT) )
+
+    def test002_gz(self):
+        """Checking opensource on a gzip compressed source"""
+        filename = os.path.join(self.tmpdir.name, "source.txt.gz")
+        with gzip.open(filename,'wt',encoding='utf-8') as f:
+            f.write(self.TEXT)
+        self.check(filename)
+
+    def test003_bz2(self):
+        """Checking opensource on a bzip2 compressed source"""
+        filename = os.path.join(self.tmpdir.name, "source.txt.bz2")
+        with bz2.open(filename,'wt',encoding='utf-8') as f:
+            f.write(self.TEXT)
+        self.check(filename)
+
+    @unittest.skipIf(zstandard is None, "zstandard is not installed")
+    def test004_zst(self):
+        """Checking opensource on a zstd compressed source"""
+        filename = os.path.join(self.tmpdir.name, "source.txt.zst")
+        with zstandard.open(filename,'wt',encoding='utf-8') as f:
+            f.write(self.TEXT)
+        self.check(filename)
+
+
+class SentenceContextTest(unittest.TestCase):
+    def setUp(self):
+        self.doc = folia.Document(id='test')
+        text = self.doc.append(folia.Text)
+        for i, sentence in enumerate(("the cat sat", "it ran")):
+            s = text.append(folia.Sentence, id='test.s.' + str(i+1))
+            for j, token in enumerate(sentence.split()):
+                s.append(folia.Word, token, id=s.id + '.w.' + str(j+1))
+
+    def test001_withinsentence(self):
+        """Checking contexts that lie within the sentence"""
+        getcontext = SentenceContext()
+        self.assertEqual( getcontext(self.doc['test.s.1.w.2'], 1, 1), (("the",), ("sat",)) )
+        self.assertEqual( getcontext(self.doc['test.s.1.w.3'], 2, 0), (("the","cat"), ()) )
+
+    def test002_boundaries(self):
+        """Checking contexts that extend beyond the sentence or the document"""
+        getcontext = SentenceContext()
+        self.assertEqual( getcontext(self.doc['test.s.1.w.1'], 2, 1), (("<begin>","<begin>"), ("cat",)) )
+        self.assertEqual( getcontext(self.doc['test.s.1.w.3'], 1, 2), (("cat",), ("it","ran")) )
+        self.assertEqual( getcontext(self.doc['test.s.2.w.2'], 3, 1), (("cat","sat","it"), ("<end>",)) )
+        self.assertEqual( getcontext(self.doc['test.s.1.w.2'], 1, 1), (("the",), ("sat",)) ) #back to the first sentence
+
+
+class ConfusibleBatchTest(unittest.TestCase):
+    def setUp(self):
+        self.doc = folia.Document(id='test')
+        sentence = self.doc.append(folia.Text).append(folia.Sentence, id='test.s.1')
+        for i, (token, cls) in enumerate( (("I","WORD"), ("want","WORD"), ("2","NUMBER"), ("go","WORD"), ("to","WORD"), ("bed","WORD")) ):
+            sentence.append(folia.Word, token, id='test.s.1.w.' + str(i+1), cls=cls)
+
+    def getmodule(self, **settings):
+        return TIMBLWordConfusibleModule(None, id='confusibles', model=os.path.abspath("confusibles.ibase"), confusibles=["to","two","2"], leftcontext=1, rightcontext=1, logfunction=lambda x: None, **settings)
+
+    def test001_unitfilter(self):
+        """Checking that number tokens are skipped alike with and without batch mode"""
+        module = self.getmodule()
+        inputdata = [ module.prepareinput(word) for word in self.doc.words() ]
+        self.assertEqual( [ (word.id,) + wordinput for word, wordinput in zip(self.doc.words(), inputdata) if wordinput is not None ], [ ('test.s.1.w.5', "to", ("go","bed")) ] )
+        module = self.getmodule(batch=True)
+        self.assertEqual( module.prepareinput(self.doc['test.s.1']), [ ('test.s.1.w.5', "to", ("go","bed")) ] )
+
+
+class FramedProtocolTest(unittest.TestCase):
+    def setUp(self):
+        if msgpack is None:
+            self.skipTest("msgpack is not installed")
+        self.clientsocket, self.serversocket = socket.socketpair()
+        self.client = FramedClient("localhost", 0)
+        self.client.socket = self.clientsocket
+        self.client.connected = True
+
+    def tearDown(self):
+        self.clientsocket.close()
+        self.serversocket.close()
+
+    def test001_send(self):
+        """Checking that a message is sent as a single frame with a length prefix"""
+        self.client.send(FramedClient.encode("teh"))
+        self.assertEqual( recvexactly(self.serversocket, 8), b"\x04\x00\x00\x00\xa3teh" )
+
+    def test002_receive(self):
+        """Checking that a length prefixed frame is received in full, also when it takes multiple reads"""
+        self.serversocket.sendall(b"\x04\x00\x00\x00\xa3teh")
+        self.assertEqual( self.client.receive(), b"\xa3teh" )
+        msg = FramedClient.encode("x" * 100000)
+        sender = threading.Thread(target=self.serversocket.sendall, args=(FRAMEHEADER.pack(len(msg)) + msg,), daemon=True) #may exceed the socket buffer
+        sender.start()
+        self.assertEqual( FramedClient.decode(self.client.receive()), "x" * 100000 )
+
+    def test003_closed(self):
+        """Checking that a prematurely closed connection is detected"""
+        self.serversocket.sendall(b"\x0a\x00\x00\x00abc")
+        self.serversocket.shutdown(socket.SHUT_WR)
+        self.assertRaises( ConnectionError, self.client.receive )
+
+    def test004_server(self):
+        """Checking a round trip through FramedServerHandler, including the textual load request"""
+        class EchoModule:
+            def run(self, inputdata):
+                return [inputdata, len(inputdata)]
+            def server_load(self):
+                return 0.5
+        class Server:
+            module = EchoModule()
+        handler = threading.Thread(target=FramedServerHandler, args=(self.serversocket, None, Server()), daemon=True)
+        handler.start()
+        self.assertEqual( FramedClient.decode(self.client.communicate(FramedClient.encode("teh"))), ["teh", 3] )
+        self.assertEqual( FramedClient.decode(self.client.communicate(FramedClient.encode(["the","ten"]))), [["the","ten"], 2] )
+        self.clientsocket.sendall(b"%GETLOAD%\n")
+        self.assertEqual( self.clientsocket.recv(1024), b"0.5\n" )
+        self.clientsocket.shutdown(socket.SHUT_WR) #ends the handler
+        handler.join(10)
+        self.assertFalse( handler.is_alive() )
+
+
+class LexiconTest(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def getmodule(self, modelfile, **settings):
+        return LexiconModule(None, id='lexicon', model=modelfile, logfunction=lambda x: None, **settings)
+
+    def test001_readmodel(self):
+        """Checking the lexicon parse, words occurring up to minfreqthreshold times are left out"""
+        modelfile = writefile(os.path.join(self.tmpdir.name, "lexicon.txt"), "the\t500000\nthen\t200000\n\n café \t 150000 \nthn\t20\nthan\t20000\n")
+        self.assertEqual( self.getmodule(modelfile, minfreqthreshold=10000).readmodel(modelfile), {'the': 500000, 'then': 200000, 'café': 150000, 'than': 20000} ) #not ordered, so all of it is read
+        self.assertEqual( self.getmodule(modelfile, minfreqthreshold=0).readmodel(modelfile), {'the': 500000, 'then': 200000, 'café': 150000, 'thn': 20, 'than': 20000} )
+
+    def test002_reversed(self):
+        """Checking the lexicon parse of a model with freq,word pairs"""
+        modelfile = writefile(os.path.join(self.tmpdir.name, "lexicon.txt"), "20,thn\n500000,the\n200000,then\n")
+        self.assertEqual( self.getmodule(modelfile, minfreqthreshold=10, reversedformat=True, delimiter='comma').readmodel(modelfile), {'thn': 20, 'the': 500000, 'then': 200000} )
+
+    def test003_ordered(self):
+        """Checking that reading stops at the first infrequent word only if the model is explicitly ordered, and not once it turns out to be unordered"""
+        modelfile = writefile(os.path.join(self.tmpdir.name, "lexicon.txt"), "the\t500000\nthen\t200000\nthn\t20\nnot a\tline\n") #the last line is never reached
+        self.assertEqual( self.getmodule(modelfile, minfreqthreshold=10000, ordered=True).readmodel(modelfile), {'the': 500000, 'then': 200000} )
+        modelfile = writefile(os.path.join(self.tmpdir.name, "lexicon2.txt"), "than\t20000\nthe\t500000\nthn\t20\nthen\t200000\n")
+        self.assertEqual( self.getmodule(modelfile, minfreqthreshold=10000, ordered=True).readmodel(modelfile), {'than': 20000, 'the': 500000, 'then': 200000} )
+
+    def test004_findclosest(self):
+        """Checking lexicon suggestions, the closest first and equally close ones by frequency"""
+        modelfile = writefile(os.path.join(self.tmpdir.name, "lexicon.txt"), "receive\t500000\nretrieve\t400000\nrelieve\t300000\nrecede\t200000\ndeceive\t150000\nbelieve\t100000\n")
+        module = self.getmodule(modelfile, minfreqthreshold=10, maxnrclosest=3)
+        module.load()
+        self.assertEqual( module.findclosest("recieve"), [("relieve",1), ("receive",2), ("retrieve",2)] )
+        self.assertEqual( module.findclosest("receive"), [] ) #in the lexicon, nothing is frequent enough to be suggested instead
+        self.assertEqual( module.findclosest("cat"), False ) #too short
+
+    def test005_withindistance(self):
+        """Checking the candidates within a maximum distance, in order, without any case folding"""
+        candidates = ["word", "Word", "words", "ward", "wrd", "sword", "xyzzy", "wordwordword"]
+        self.assertEqual( list(withindistance("word", candidates, 0)), [(0,0)] )
+        self.assertEqual( list(withindistance("word", candidates, 1)), [(0,0), (1,1), (2,1), (3,1), (4,1), (5,1)] )
+        self.assertEqual( list(withindistance("wodr", candidates, 2)), [(0,2), (2,2), (4,2)] )
+        self.assertEqual( list(withindistance("word", [], 2)), [] )
+
+
+class CacheTest(unittest.TestCase):
+    def test001_getcache(self):
+        """Checking that getcache honours the cachesize and cachetype settings"""
+        cache = getcache({'cachesize': 3}, 1000)
+        self.assertIsInstance( cache, FIFOCache )
+        self.assertEqual( cache.size, 3 )
+        self.assertEqual( getcache({}, 10).size, 10 )
+        self.assertIsInstance( getcache({'cachetype': 'lru'}), LRUCache )
+        self.assertRaises( Exception, getcache, {'cachetype': 'foo'} )
+
+    def test002_fifo(self):
+        """Checking that FIFOCache evicts the oldest entry, regardless of use"""
+        cache = FIFOCache(3)
+        for i in range(4):
+            cache.append(i, str(i))
+            cache.get(0)
+        self.assertEqual( list(cache.items()), [(1,"1"), (2,"2"), (3,"3")] )
+
+    def test003_lru(self):
+        """Checking that LRUCache evicts the least recently used entry"""
+        cache = LRUCache(2)
+        cache.append('a', 1)
+        cache.append('b', 2)
+        self.assertEqual( cache.get('a'), 1 )
+        cache.append('c', 3)
+        self.assertEqual( list(cache), ['a','c'] )
+        self.assertEqual( cache['a'], 1 )
+        cache.append('d', 4)
+        self.assertEqual( list(cache), ['a','d'] )
+        self.assertIsNone( cache.get('b') )
+
+    def test004_nocache(self):
+        """Checking that a cache of size 0 caches nothing"""
+        cache = getcache({'cachesize': 0})
+        cache.append('a', 1)
+        self.assertEqual( len(cache), 0 )
+
+
+if __name__ == '__main__':
+    unittest.main()